@@ -7,6 +7,8 @@
 //
 //===----------------------------------------------------------------------===//
 
+// FILE-DEP:
+
 // REQUIRES: locale.en_US.UTF-8
 
 // <fstream>
@@ -7,6 +7,8 @@
 //
 //===----------------------------------------------------------------------===//
 
+// FILE-DEP: underflow.dat
+
 // <fstream>
 
 // int_type pbackfail(int_type c = traits::eof());
@@ -7,6 +7,8 @@
 //
 //===----------------------------------------------------------------------===//
 
+// FILE-DEP:
+
 // <fstream>
 
 // pos_type seekoff(off_type off, ios_base::seekdir way,
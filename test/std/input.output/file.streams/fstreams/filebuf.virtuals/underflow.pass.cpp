@@ -7,6 +7,8 @@
 //
 //===----------------------------------------------------------------------===//
 
+// FILE-DEP: underflow.dat, underflow_utf8.dat
+
 // REQUIRES: locale.en_US.UTF-8
 
 // <fstream>
@@ -7,6 +7,8 @@
 //
 //===----------------------------------------------------------------------===//
 
+// FILE-DEP:
+
 // <fstream>
 
 // template <class charT, class traits = char_traits<charT> >
@@ -7,6 +7,8 @@
 //
 //===----------------------------------------------------------------------===//
 
+// FILE-DEP: test.dat
+
 // UNSUPPORTED: c++98, c++03
 
 // <fstream>
@@ -7,6 +7,8 @@
 //
 //===----------------------------------------------------------------------===//
 
+// FILE-DEP: test.dat
+
 // <fstream>
 
 // template <class charT, class traits = char_traits<charT> >
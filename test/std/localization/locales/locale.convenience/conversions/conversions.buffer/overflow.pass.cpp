@@ -7,6 +7,8 @@
 //
 //===----------------------------------------------------------------------===//
 
+// FILE-DEP:
+
 // <locale>
 
 // wbuffer_convert<Codecvt, Elem, Tr>
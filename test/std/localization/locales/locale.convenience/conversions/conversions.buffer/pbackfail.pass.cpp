@@ -7,6 +7,8 @@
 //
 //===----------------------------------------------------------------------===//
 
+// FILE-DEP: underflow.dat
+
 // <locale>
 
 // wbuffer_convert<Codecvt, Elem, Tr>
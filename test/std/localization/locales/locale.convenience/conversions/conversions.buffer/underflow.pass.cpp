@@ -7,6 +7,8 @@
 //
 //===----------------------------------------------------------------------===//
 
+// FILE-DEP: underflow.dat, underflow_utf8.dat
+
 // <locale>
 
 // wbuffer_convert<Codecvt, Elem, Tr>
@@ -0,0 +1,205 @@
+#===----------------------------------------------------------------------===##
+#
+#                     The LLVM Compiler Infrastructure
+#
+# This file is dual licensed under the MIT and the University of Illinois Open
+# Source Licenses. See LICENSE.TXT for details.
+#
+#===----------------------------------------------------------------------===##
+
+import json
+import os
+import shutil
+import tempfile
+
+import libcxx.util
+
+
+class PersistentCache(object):
+    """
+    A directory of JSON documents indexed by a hex digest key.
+
+    Entries are written atomically, so the cache can be shared between the
+    worker processes of a single lit run and between separate runs. A missing
+    or unreadable entry is simply reported as a miss.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _entryPath(self, key):
+        return os.path.join(self.root, key[:2], key[2:] + '.json')
+
+    def get(self, key):
+        try:
+            with open(self._entryPath(key), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def touch(self, key):
+        # Mark the entry as recently used.
+        try:
+            os.utime(self._entryPath(key), None)
+        except OSError:
+            pass
+
+    def put(self, key, value):
+        try:
+            libcxx.util.writeFileAtomic(self._entryPath(key),
+                                        json.dumps(value))
+        except (IOError, OSError):
+            # The cache is only an optimization; failing to populate it
+            # must never fail the caller.
+            pass
+
+
+def fingerprintFiles(paths):
+    """
+    Return a list of [path, size, mtime, digest] records describing the
+    current contents of each file in "paths", or None if any of them cannot
+    be read.
+    """
+    fingerprints = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            digest = libcxx.util.hashFile(path)
+        except (IOError, OSError):
+            return None
+        fingerprints += [[path, st.st_size, st.st_mtime, digest]]
+    return fingerprints
+
+
+def fingerprintsMatch(fingerprints):
+    """
+    Return True if every file described by "fingerprints" (as returned by
+    fingerprintFiles) still has the same contents. Files whose size and
+    modification time are unchanged are assumed to be unchanged; otherwise
+    their contents are hashed again.
+    """
+    for path, size, mtime, digest in fingerprints:
+        try:
+            st = os.stat(path)
+            if st.st_size != size:
+                return False
+            if st.st_mtime != mtime and libcxx.util.hashFile(path) != digest:
+                return False
+        except (IOError, OSError):
+            return False
+    return True
+
+
+class CompileCache(object):
+    """
+    The results of compiler invocations, including the object files they
+    produce.
+
+    An entry records the exit code and output of a compilation together with
+    the fingerprints of every file it read, and is only reused while none of
+    them has changed. Object files are stored next to the entries. Reusing an
+    entry marks it as recently used so that, once the cache grows beyond
+    "max_size" bytes, the least recently used entries are evicted first.
+    """
+
+    def __init__(self, root, max_size, stats=None):
+        self.root = root
+        self.max_size = max_size
+        self.stats = stats
+        self.entries = PersistentCache(root)
+
+    def _objectPath(self, key):
+        return os.path.join(self.root, key[:2], key[2:] + '.o')
+
+    def _record(self, hit):
+        if self.stats is not None:
+            self.stats.record('compile-cache', hit=hit)
+
+    def lock(self, key):
+        """Return a context manager holding an exclusive lock on "key"
+        across the processes of the run."""
+        return libcxx.util.lockedFile(
+            os.path.join(self.root, key[:2], key[2:] + '.lock'))
+
+    def lookup(self, key, out=None):
+        """Return the entry stored for "key", copying its object file to
+        "out", or None if there is no usable entry."""
+        entry = self.entries.get(key)
+        if entry is not None and entry['rc'] < 0:
+            # Recorded from a compiler killed by a signal.
+            entry = None
+        if entry is not None and not fingerprintsMatch(entry['inputs']):
+            entry = None
+        if entry is not None and entry['object'] and out is not None:
+            try:
+                shutil.copyfile(self._objectPath(key), out)
+            except (IOError, OSError):
+                # The entry was evicted under our feet.
+                entry = None
+        self._record(entry is not None)
+        if entry is None:
+            return None
+        self.entries.touch(key)
+        return entry
+
+    def store(self, key, inputs, rc, out, err, depfile=None,
+              object_path=None):
+        fingerprints = fingerprintFiles(inputs)
+        if fingerprints is None:
+            return
+        has_object = False
+        if object_path is not None and os.path.isfile(object_path):
+            # Store the object before the entry so that an entry is never
+            # seen without its object.
+            tmp_name = None
+            try:
+                dst = self._objectPath(key)
+                libcxx.util.mkdir_p(os.path.dirname(dst))
+                handle, tmp_name = tempfile.mkstemp(prefix='.tmp',
+                                                    dir=os.path.dirname(dst))
+                os.close(handle)
+                shutil.copyfile(object_path, tmp_name)
+                libcxx.util.replaceFile(tmp_name, dst)
+                has_object = True
+            except (IOError, OSError):
+                if tmp_name is not None:
+                    libcxx.util.cleanFile(tmp_name)
+                return
+        self.entries.put(key, {'rc': rc, 'out': out, 'err': err,
+                               'depfile': depfile, 'object': has_object,
+                               'inputs': fingerprints})
+
+    def evict(self):
+        """Remove the least recently used entries until the cache holds no
+        more than "max_size" bytes. Return the number of entries removed."""
+        if not os.path.isdir(self.root):
+            return 0
+        with libcxx.util.lockedFile(os.path.join(self.root, 'evict.lock')):
+            entries = []
+            total = 0
+            for dirpath, _, filenames in os.walk(self.root):
+                for name in filenames:
+                    if not name.endswith('.json'):
+                        continue
+                    entry = os.path.join(dirpath, name)
+                    obj = entry[:-len('.json')] + '.o'
+                    lock = entry[:-len('.json')] + '.lock'
+                    try:
+                        st = os.stat(entry)
+                        size = st.st_size
+                        if os.path.exists(obj):
+                            size += os.path.getsize(obj)
+                    except OSError:
+                        continue
+                    entries += [(st.st_mtime, size, entry, obj, lock)]
+                    total += size
+            removed = 0
+            for _, size, entry, obj, lock in sorted(entries):
+                if total <= self.max_size:
+                    break
+                libcxx.util.cleanFile(entry)
+                libcxx.util.cleanFile(obj)
+                libcxx.util.cleanFile(lock)
+                total -= size
+                removed += 1
+            return removed
@@ -7,11 +7,55 @@
 #
 #===----------------------------------------------------------------------===##
 
+from multiprocessing.pool import ThreadPool
+import copy
+import multiprocessing
 import platform
 import os
+import re
+import shlex
 import libcxx.util
 
 
+# Results of flag probes, keyed by CXXCompiler._probeKey. This is shared by
+# every compiler object of the process, including the copies the test format
+# makes for each test.
+_probe_results = {}
+
+# Digests identifying compiler binaries, keyed by path, size and mtime.
+_compiler_identities = {}
+
+# Environment variables which may change the outcome of a flag probe.
+_probe_env_vars = ['CPATH', 'C_INCLUDE_PATH', 'CPLUS_INCLUDE_PATH',
+                   'OBJC_INCLUDE_PATH', 'LIBRARY_PATH', 'COMPILER_PATH',
+                   'GCC_EXEC_PREFIX', 'SDKROOT', 'MACOSX_DEPLOYMENT_TARGET',
+                   'IPHONEOS_DEPLOYMENT_TARGET', 'CCACHE_CPP2']
+
+# Results of CXXCompiler.introspect, keyed like the flag probes.
+_introspection_results = {}
+
+# Templates of the job run by the clang driver for a command, keyed like the
+# flag probes. None marks a command whose job cannot be run directly.
+_driver_jobs = {}
+
+# How many flag probes may run at the same time.
+_probe_jobs = min(multiprocessing.cpu_count(), 16)
+
+
+def _mentionsFlag(err, flag):
+    # Return True if a diagnostic in "err" names "flag". Spelling suggestions
+    # and the warning option reported at the end of a line are ignored, as
+    # are the command lines printed by '-v'.
+    flag_re = re.compile(r'(?<![\w=+#-])%s(?![\w=+#-])' % re.escape(flag))
+    for line in err.splitlines():
+        if not re.search(r'\b(error|warning|note):', line):
+            continue
+        line = re.sub(r'\s*\[[^\]]*\]\s*$', '', line.split(';')[0])
+        if flag_re.search(line):
+            return True
+    return False
+
+
 class CXXCompiler(object):
     CM_Default = 0
     CM_PreProcess = 1
@@ -22,8 +66,10 @@ class CXXCompiler(object):
                  warning_flags=None, verify_supported=None,
                  verify_flags=None, use_verify=False,
                  modules_flags=None, use_modules=False,
+                 pch_flags=None, use_pch=False,
                  use_ccache=False, use_warnings=False, compile_env=None,
-                 cxx_type=None, cxx_version=None):
+                 cxx_type=None, cxx_version=None, probe_cache=None,
+                 use_cc1=False, compile_cache=None):
         self.source_lang = 'c++'
         self.path = path
         self.flags = list(flags or [])
@@ -38,17 +84,42 @@ class CXXCompiler(object):
         self.modules_flags = list(modules_flags or [])
         self.use_modules = use_modules
         assert not use_modules or modules_flags is not None
+        self.pch_flags = list(pch_flags or [])
+        self.use_pch = use_pch
+        assert not use_pch or pch_flags is not None
         self.use_ccache = use_ccache
         self.use_warnings = use_warnings
         if compile_env is not None:
             self.compile_env = dict(compile_env)
         else:
             self.compile_env = None
+        # A libcxx.cache.PersistentCache holding the results of flag probes
+        # across runs, or None to only remember them in this process.
+        self.probe_cache = probe_cache
+        self.use_cc1 = use_cc1
+        # A libcxx.cache.CompileCache reused by compile(), or None.
+        self.compile_cache = compile_cache
         self.type = cxx_type
         self.version = cxx_version
         if self.type is None or self.version is None:
             self._initTypeAndVersion()
 
+    # The attributes which are modified in place, like "compile_flags +=".
+    _list_attributes = ['flags', 'compile_flags', 'link_flags',
+                        'warning_flags', 'verify_flags', 'modules_flags',
+                        'pch_flags']
+
+    def copy(self):
+        """Return a copy of the compiler whose flags and settings can be
+        changed without affecting this one. Unlike copy.deepcopy, the flags
+        themselves and the caches are shared rather than copied."""
+        other = copy.copy(self)
+        for name in self._list_attributes:
+            setattr(other, name, list(getattr(self, name)))
+        if self.compile_env is not None:
+            other.compile_env = dict(self.compile_env)
+        return other
+
     def isVerifySupported(self):
         if self.verify_supported is None:
             self.verify_supported = self.hasCompileFlag(['-Xclang',
@@ -69,17 +140,41 @@ class CXXCompiler(object):
         self.use_modules = value
         assert not self.use_modules or self.modules_flags is not None
 
+    def usePCH(self, value=True):
+        self.use_pch = value
+        assert not self.use_pch or self.pch_flags is not None
+
     def useCCache(self, value=True):
         self.use_ccache = value
 
     def useWarnings(self, value=True):
         self.use_warnings = value
 
+    def useCC1(self, value=True):
+        self.use_cc1 = value
+
     def _initTypeAndVersion(self):
         # Get compiler type and version
-        macros = self.dumpMacros()
-        if macros is None:
+        info = self.introspect()
+        if isinstance(info, tuple):
             return
+        self.type = info['type']
+        self.version = tuple(info['version'])
+
+    @staticmethod
+    def _parseMacros(out):
+        parsed_macros = {}
+        lines = [l.strip() for l in out.split('\n') if l.strip()]
+        for l in lines:
+            assert l.startswith('#define ')
+            l = l[len('#define '):]
+            macro, _, value = l.partition(' ')
+            parsed_macros[macro] = value
+        return parsed_macros
+
+    @staticmethod
+    def _parseIntrospection(out, err):
+        macros = CXXCompiler._parseMacros(out)
         compiler_type = None
         major_ver = minor_ver = patchlevel = None
         if '__clang__' in macros.keys():
@@ -95,8 +190,60 @@ class CXXCompiler(object):
             major_ver = macros['__GNUC__']
             minor_ver = macros['__GNUC_MINOR__']
             patchlevel = macros['__GNUC_PATCHLEVEL__']
-        self.type = compiler_type
-        self.version = (major_ver, minor_ver, patchlevel)
+        triple = None
+        resource_dir = None
+        include_paths = []
+        in_search_list = False
+        for line in err.splitlines():
+            if line.startswith('Target: '):
+                triple = line[len('Target: '):].strip()
+            elif line.startswith('#include <...> search starts here:'):
+                in_search_list = True
+            elif line.startswith('End of search list.'):
+                in_search_list = False
+            elif in_search_list:
+                include_paths += [line.strip().replace(
+                    ' (framework directory)', '')]
+            elif resource_dir is None and line.startswith(' '):
+                # The frontend invocation: Clang passes its resource
+                # directory explicitly while GCC keeps its own next to cc1.
+                m = re.search(r'\s-resource-dir\s+"?([^"\s]+)', line)
+                if m:
+                    resource_dir = m.group(1)
+                else:
+                    m = re.match(r'\s*"?(\S*cc1\S*?)"?\s', line)
+                    if m and compiler_type == 'gcc':
+                        resource_dir = os.path.dirname(m.group(1))
+        return {'macros': macros, 'type': compiler_type,
+                'version': [major_ver, minor_ver, patchlevel],
+                'triple': triple, 'resource_dir': resource_dir,
+                'include_paths': include_paths}
+
+    def introspect(self, flags=[]):
+        """
+        introspect - Describe the compiler as configured with "flags". Return
+        a dictionary holding its predefined 'macros', its 'type' and 'version'
+        (as used by CXXCompiler), the target 'triple', its 'resource_dir'
+        and its default 'include_paths', all gathered by a single run of the
+        preprocessor. The result is cached like the flag probes are. If the
+        compiler fails, the (cmd, out, err, rc) tuple is returned instead.
+        """
+        cmd = self.preprocessCmd(os.devnull, flags=['-dM', '-v'] + flags)
+        key = self._probeKey('introspect', cmd)
+        info = _introspection_results.get(key) if key else None
+        if info is None and key and self.probe_cache is not None:
+            info = self.probe_cache.get(key)
+        if info is None:
+            out, err, rc = libcxx.util.executeCommand(cmd,
+                                                      env=self.compile_env)
+            if rc != 0:
+                return cmd, out, err, rc
+            info = self._parseIntrospection(out, err)
+            if key and self.probe_cache is not None:
+                self.probe_cache.put(key, info)
+        if key:
+            _introspection_results[key] = info
+        return info
 
     def _basicCmd(self, source_files, out, mode=CM_Default, flags=[],
                   input_is_cxx=False):
@@ -126,6 +273,8 @@ class CXXCompiler(object):
             assert mode in [self.CM_Default, self.CM_Compile]
         if self.use_modules:
             cmd += self.modules_flags
+        if self.use_pch and mode != self.CM_Link:
+            cmd += self.pch_flags
         if mode != self.CM_Link:
             cmd += self.compile_flags
             if self.use_warnings:
@@ -152,30 +301,191 @@ class CXXCompiler(object):
     def compileLinkCmd(self, source_files, out=None, flags=[]):
         return self._basicCmd(source_files, out, flags=flags)
 
-    def preprocess(self, source_files, out=None, flags=[], cwd=None):
-        cmd = self.preprocessCmd(source_files, out, flags)
+    def _driverJob(self, cmd, source_files, out, cwd):
+        # Return the single job the clang driver would run for "cmd", or
+        # None if it runs several or the job cannot be reused. The job is
+        # obtained from '-###' once for each command that differs only in
+        # its input, output, dependency file and working directory, which
+        # are substituted back in here.
+        if self.use_ccache or not isinstance(source_files, str):
+            return None
+        cwd = os.path.abspath(cwd or os.getcwd())
+        subst = [('@@SOURCE@@', source_files),
+                 ('@@SOURCE_NAME@@', os.path.basename(source_files)),
+                 ('@@CWD@@', cwd)]
+        if out is not None:
+            subst += [('@@OUTPUT@@', out)]
+        shape = [a if a not in (source_files, out) else
+                 ('@@SOURCE@@' if a == source_files else '@@OUTPUT@@')
+                 for a in cmd]
+        if '-MF' in shape[:-1]:
+            # Without an output, the target named in the dependency file is
+            # derived from the name of the source.
+            if out is None:
+                return None
+            index = shape.index('-MF') + 1
+            subst += [('@@DEPFILE@@', cmd[index])]
+            shape[index] = '@@DEPFILE@@'
+        key = self._probeKey('driver-job', shape)
+        if key is None:
+            return None
+        if key in _driver_jobs:
+            template = _driver_jobs[key]
+        else:
+            entry = None
+            if self.probe_cache is not None:
+                entry = self.probe_cache.get(key)
+            if entry is not None:
+                template = entry.get('job')
+            else:
+                template = self._makeDriverJobTemplate(cmd, subst, cwd)
+                if self.probe_cache is not None:
+                    self.probe_cache.put(key, {'job': template})
+            _driver_jobs[key] = template
+        if template is None:
+            return None
+        values = dict(subst)
+        job = []
+        for arg in template:
+            for placeholder in re.findall(r'@@\w+@@', arg):
+                arg = arg.replace(placeholder, values[placeholder])
+            job += [arg]
+        return job
+
+    def _makeDriverJobTemplate(self, cmd, subst, cwd):
+        out, err, rc = libcxx.util.executeCommand(
+            cmd + ['-###'], env=self.compile_env, cwd=cwd)
+        if rc != 0:
+            return None
+        jobs = [l for l in err.splitlines() if l.startswith(' "')]
+        if len(jobs) != 1:
+            return None
+        values = dict((v, p) for p, v in subst if p != '@@SOURCE_NAME@@')
+        template = []
+        prev = None
+        for arg in shlex.split(jobs[0]):
+            if prev == '-main-file-name' and arg == subst[1][1]:
+                arg = '@@SOURCE_NAME@@'
+            elif arg in values:
+                arg = values[arg]
+            elif '=' + cwd in arg:
+                # e.g. -fdebug-compilation-dir=<cwd>
+                arg = arg.replace('=' + cwd, '=@@CWD@@')
+            prev = arg
+            template += [arg]
+        # Give up if the input or output still appear in some other form,
+        # since they would not be substituted.
+        for placeholder, value in subst:
+            if placeholder in ('@@SOURCE@@', '@@OUTPUT@@',
+                               '@@DEPFILE@@') and \
+                    any(value in arg for arg in template):
+                return None
+        return template
+
+    def _run(self, cmd, source_files, out, cwd):
+        # Run "cmd", invoking the job of the clang driver directly in cc1
+        # mode. Return the command actually run with its results.
+        if self.use_cc1:
+            job = self._driverJob(cmd, source_files, out, cwd)
+            if job is not None:
+                cmd = job
         out, err, rc = libcxx.util.executeCommand(cmd, env=self.compile_env,
                                                   cwd=cwd)
         return cmd, out, err, rc
 
+    def preprocess(self, source_files, out=None, flags=[], cwd=None):
+        cmd = self.preprocessCmd(source_files, out, flags)
+        with libcxx.util.traceSpan('preprocess'):
+            return self._run(cmd, source_files, out, cwd)
+
     def compile(self, source_files, out=None, flags=[], cwd=None):
         cmd = self.compileCmd(source_files, out, flags)
-        out, err, rc = libcxx.util.executeCommand(cmd, env=self.compile_env,
-                                                  cwd=cwd)
-        return cmd, out, err, rc
+        with libcxx.util.traceSpan('compile'):
+            # The state of the module cache is not captured by the
+            # dependencies of a compilation, so those are never cached.
+            if self.compile_cache is not None and \
+                    isinstance(source_files, str) and not self.use_modules:
+                return self._cachedCompile(cmd, source_files, out, flags,
+                                           cwd)
+            return self._run(cmd, source_files, out, cwd)
+
+    def _cachedCompile(self, cmd, source_file, out, flags, cwd):
+        abs_cwd = os.path.abspath(cwd or os.getcwd())
+        # The output file is not part of the key: it is copied out of the
+        # cache to wherever it is wanted.
+        shape = ['@@OUTPUT@@' if a == out else a for a in cmd]
+        # Neither is the dependency file, whose contents are replayed.
+        if '-MF' in shape[:-1]:
+            shape[shape.index('-MF') + 1] = '@@DEPFILE@@'
+        key = self._probeKey('compile', shape + [abs_cwd])
+        if key is None:
+            return self._run(cmd, source_file, out, cwd)
+        # Hold the entry while compiling, so that the same command run by
+        # another worker at the same time, such as the compile of the same
+        # test in another configuration of a matrix run, waits for it and
+        # reuses it.
+        with self.compile_cache.lock(key):
+            return self._compileEntry(key, cmd, source_file, out, flags, cwd,
+                                      abs_cwd)
+
+    def _compileEntry(self, key, cmd, source_file, out, flags, cwd, abs_cwd):
+        dep_path = None
+        if '-MF' in cmd:
+            dep_path = os.path.join(abs_cwd, cmd[cmd.index('-MF') + 1])
+        object_path = out if out not in (None, os.devnull) else None
+        if object_path is not None:
+            object_path = os.path.join(abs_cwd, object_path)
+        entry = self.compile_cache.lookup(key, object_path)
+        if entry is not None:
+            if dep_path is not None and entry['depfile'] is not None:
+                libcxx.util.writeFileAtomic(dep_path, entry['depfile'])
+            return cmd, entry['out'], entry['err'], entry['rc']
+        with libcxx.util.guardedTempFilename(suffix='.d') as tmp_dep:
+            run_cmd = cmd
+            if dep_path is None:
+                run_cmd = cmd + ['-MD', '-MF', tmp_dep]
+            run_cmd, stdout, stderr, rc = self._run(run_cmd, source_file,
+                                                    out, cwd)
+            deps = libcxx.util.parseDepFile(dep_path or tmp_dep)
+            if deps is None:
+                # GCC does not write the dependency file when compilation
+                # fails, so list the dependencies with the preprocessor.
+                old_use_verify = self.use_verify
+                self.useVerify(False)
+                dep_cmd = self.preprocessCmd(
+                    source_file, flags=flags + ['-M', '-MF', tmp_dep])
+                self.useVerify(old_use_verify)
+                dep_cmd = [a for a in dep_cmd if a != '-fsyntax-only']
+                libcxx.util.executeCommand(dep_cmd, env=self.compile_env,
+                                           cwd=cwd)
+                deps = libcxx.util.parseDepFile(tmp_dep)
+            # A compiler killed by a signal, for instance when the run is
+            # stopped early, says nothing about the source.
+            if deps is not None and rc >= 0:
+                inputs = [os.path.join(abs_cwd, d) for d in deps]
+                # A precompiled header is not necessarily listed.
+                inputs += [os.path.join(abs_cwd, cmd[i + 1])
+                           for i, a in enumerate(cmd[:-1])
+                           if a == '-include-pch']
+                depfile = None
+                if dep_path is not None:
+                    with open(dep_path, 'r') as f:
+                        depfile = f.read()
+                self.compile_cache.store(
+                    key, inputs, rc, stdout, stderr, depfile=depfile,
+                    object_path=object_path if rc == 0 else None)
+        return run_cmd, stdout, stderr, rc
 
     def link(self, source_files, out=None, flags=[], cwd=None):
         cmd = self.linkCmd(source_files, out, flags)
-        out, err, rc = libcxx.util.executeCommand(cmd, env=self.compile_env,
-                                                  cwd=cwd)
-        return cmd, out, err, rc
+        with libcxx.util.traceSpan('link'):
+            return self._run(cmd, source_files, out, cwd)
 
     def compileLink(self, source_files, out=None, flags=[],
                     cwd=None):
         cmd = self.compileLinkCmd(source_files, out, flags)
-        out, err, rc = libcxx.util.executeCommand(cmd, env=self.compile_env,
-                                                  cwd=cwd)
-        return cmd, out, err, rc
+        with libcxx.util.traceSpan('compile-link'):
+            return self._run(cmd, source_files, out, cwd)
 
     def compileLinkTwoSteps(self, source_file, out=None, object_file=None,
                             flags=[], cwd=None):
@@ -198,38 +508,221 @@ class CXXCompiler(object):
             return (cc_cmd + ['&&'] + link_cmd, cc_stdout + link_stdout,
                     cc_stderr + link_stderr, rc)
 
+    def precompileHeader(self, header, out, flags=[], cwd=None):
+        old_source_lang = self.source_lang
+        old_use_pch = self.use_pch
+        self.source_lang += '-header'
+        self.usePCH(False)
+        cmd = self.compileCmd(header, out, flags)
+        self.source_lang = old_source_lang
+        self.usePCH(old_use_pch)
+        out, err, rc = libcxx.util.executeCommand(cmd, env=self.compile_env,
+                                                  cwd=cwd)
+        return cmd, out, err, rc
+
     def dumpMacros(self, source_files=None, flags=[], cwd=None):
         if source_files is None:
-            source_files = os.devnull
+            # Only the predefined macros are wanted.
+            info = self.introspect(flags)
+            if isinstance(info, tuple):
+                return info
+            return dict(info['macros'])
         flags = ['-dM'] + flags
         cmd, out, err, rc = self.preprocess(source_files, flags=flags, cwd=cwd)
         if rc != 0:
             return cmd, out, err, rc
-        parsed_macros = {}
-        lines = [l.strip() for l in out.split('\n') if l.strip()]
-        for l in lines:
-            assert l.startswith('#define ')
-            l = l[len('#define '):]
-            macro, _, value = l.partition(' ')
-            parsed_macros[macro] = value
-        return parsed_macros
+        return self._parseMacros(out)
 
     def getTriple(self):
+        info = self.introspect()
+        if not isinstance(info, tuple) and info['triple']:
+            return info['triple']
         cmd = [self.path] + self.flags + ['-dumpmachine']
         return libcxx.util.capture(cmd).strip()
 
-    def hasCompileFlag(self, flag):
-        if isinstance(flag, list):
-            flags = list(flag)
+    def _identity(self):
+        # Return a digest identifying the compiler binary, or None if it
+        # cannot be found. Hashing the binary is only done once for each
+        # size and mtime it is seen with.
+        exe = libcxx.util.which(self.path)
+        if exe is None:
+            return None
+        exe = os.path.realpath(exe)
+        try:
+            st = os.stat(exe)
+        except OSError:
+            return None
+        stamp = libcxx.util.hashData(exe, str(st.st_size), repr(st.st_mtime))
+        identity = _compiler_identities.get(stamp)
+        if identity is None and self.probe_cache is not None:
+            entry = self.probe_cache.get(stamp)
+            if entry is not None:
+                identity = entry.get('identity')
+        if identity is None:
+            try:
+                identity = libcxx.util.hashData(exe,
+                                                libcxx.util.hashFile(exe))
+            except (IOError, OSError):
+                return None
+            if self.probe_cache is not None:
+                self.probe_cache.put(stamp, {'identity': identity})
+        _compiler_identities[stamp] = identity
+        return identity
+
+    def _probeKey(self, kind, cmd):
+        identity = self._identity()
+        if identity is None:
+            return None
+        env = ['%s=%s' % (k, (self.compile_env or os.environ).get(k))
+               for k in _probe_env_vars
+               if k in (self.compile_env or os.environ)]
+        return libcxx.util.hashData(identity, kind, cmd, env)
+
+    def _lookupProbe(self, key):
+        # Return the memoized result of a probe, checking the in-process
+        # cache first and then the persistent one.
+        if key is None:
+            return None
+        result = _probe_results.get(key)
+        if result is None and self.probe_cache is not None:
+            entry = self.probe_cache.get(key)
+            if entry is not None:
+                result = entry.get('result')
+                if result is not None:
+                    _probe_results[key] = result
+        return result
+
+    def _storeProbe(self, key, result):
+        if key is None:
+            return
+        _probe_results[key] = result
+        if self.probe_cache is not None:
+            self.probe_cache.put(key, {'result': result})
+
+    def _cachedProbe(self, kind, cmd, probe):
+        # Memoize the boolean returned by "probe", which runs "cmd".
+        key = self._probeKey(kind, cmd)
+        result = self._lookupProbe(key)
+        if result is None:
+            result = probe()
+            self._storeProbe(key, result)
+        return result
+
+    def _probeCmd(self, kind, flags):
+        if kind == 'compile-flag':
+            flags = list(flags)
+            # Add -Werror to ensure that an unrecognized flag causes a non-zero
+            # exit code. -Werror is supported on all known compiler types.
+            if self.type is not None:
+                flags += ['-Werror', '-fsyntax-only']
+            return self.compileCmd(os.devnull, os.devnull, flags)
+        assert kind == 'warning-flag'
+        flags = ['-Werror'] + list(flags)
+        old_use_warnings = self.use_warnings
+        self.useWarnings(False)
+        cmd = self.compileCmd('-', os.devnull, flags)
+        self.useWarnings(old_use_warnings)
+        # Remove '-v' because it will cause the command line invocation
+        # to be printed as part of the error output.
+        # TODO(EricWF): Are there other flags we need to worry about?
+        if '-v' in cmd:
+            cmd.remove('-v')
+        return cmd
+
+    def _runProbe(self, kind, cmd):
+        # Run a probe command, returning its exit code and error output.
+        if kind == 'compile-flag':
+            out, err, rc = libcxx.util.executeCommand(cmd,
+                                                      env=self.compile_env)
         else:
-            flags = [flag]
-        # Add -Werror to ensure that an unrecognized flag causes a non-zero
-        # exit code. -Werror is supported on all known compiler types.
-        if self.type is not None:
-            flags += ['-Werror', '-fsyntax-only']
-        cmd, out, err, rc = self.compile(os.devnull, out=os.devnull,
-                                         flags=flags)
-        return rc == 0
+            out, err, rc = libcxx.util.executeCommand(
+                cmd, input=libcxx.util.to_bytes('#error\n'))
+            assert rc != 0
+        return rc, err
+
+    def _flagProbe(self, kind, flag):
+        # Return the command probing for "flag" and a function running it.
+        # Building the command temporarily changes this object, so it must
+        # be done before handing the probe to another thread.
+        flags = list(flag) if isinstance(flag, list) else [flag]
+        cmd = self._probeCmd(kind, flags)
+
+        def probe():
+            rc, err = self._runProbe(kind, cmd)
+            if kind == 'compile-flag':
+                return rc == 0
+            return not _mentionsFlag(err, flag)
+        return cmd, probe
+
+    def _probeBatch(self, kind, flags):
+        # Try all of "flags" together in a single compiler invocation and use
+        # the diagnostics to tell which of them were rejected. Return a dict
+        # holding the result for each flag that could be settled this way.
+        settled = {}
+        pending = list(flags)
+        while pending:
+            rc, err = self._runProbe(kind, self._probeCmd(kind, pending))
+            rejected = [f for f in pending if _mentionsFlag(err, f)]
+            for f in rejected:
+                settled[f] = False
+            pending = [f for f in pending if f not in rejected]
+            # The '#error' used to probe warning flags always fails the
+            # compilation, so every flag that is not named is supported.
+            if rc == 0 or kind == 'warning-flag':
+                for f in pending:
+                    settled[f] = True
+                break
+            # Stop when the failure cannot be attributed to any of the flags.
+            if not rejected:
+                break
+        return settled
+
+    def _probeFlags(self, kind, flags):
+        probes = [self._flagProbe(kind, f) for f in flags]
+        keys = [self._probeKey(kind, cmd) for cmd, _ in probes]
+        results = [self._lookupProbe(k) for k in keys]
+        pending = [i for i, r in enumerate(results) if r is None]
+        # Flags given as lists, and language dialects which override one
+        # another, need to be probed on their own.
+        batchable = [i for i in pending if isinstance(flags[i], str) and
+                     not flags[i].startswith('-std=')]
+        if len(batchable) > 1:
+            settled = self._probeBatch(kind, [flags[i] for i in batchable])
+            for i in batchable:
+                if flags[i] in settled:
+                    results[i] = settled[flags[i]]
+                    self._storeProbe(keys[i], results[i])
+        pending = [i for i in pending if results[i] is None]
+        if len(pending) > 1:
+            pool = ThreadPool(min(len(pending), _probe_jobs))
+            try:
+                probed = pool.map(
+                    lambda i: self._cachedProbe(kind, probes[i][0],
+                                                probes[i][1]),
+                    pending)
+            finally:
+                pool.close()
+                pool.join()
+            for i, r in zip(pending, probed):
+                results[i] = r
+        elif pending:
+            cmd, probe = probes[pending[0]]
+            results[pending[0]] = self._cachedProbe(kind, cmd, probe)
+        return results
+
+    def hasCompileFlag(self, flag):
+        cmd, probe = self._flagProbe('compile-flag', flag)
+        return self._cachedProbe('compile-flag', cmd, probe)
+
+    def hasCompileFlags(self, flags):
+        """
+        hasCompileFlags - Return a list telling whether each of "flags" is
+        supported, as hasCompileFlag would. Flags which have not been probed
+        before are first tried together in a single compiler invocation.
+        Those whose support cannot be told from its diagnostics are then
+        probed in parallel.
+        """
+        return self._probeFlags('compile-flag', flags)
 
     def addFlagIfSupported(self, flag):
         if isinstance(flag, list):
@@ -265,23 +758,28 @@ class CXXCompiler(object):
         assert flag.startswith('-W')
         if not flag.startswith('-Wno-'):
             return self.hasCompileFlag(flag)
-        flags = ['-Werror', flag]
-        old_use_warnings = self.use_warnings
-        self.useWarnings(False)
-        cmd = self.compileCmd('-', os.devnull, flags)
-        self.useWarnings(old_use_warnings)
-        # Remove '-v' because it will cause the command line invocation
-        # to be printed as part of the error output.
-        # TODO(EricWF): Are there other flags we need to worry about?
-        if '-v' in cmd:
-            cmd.remove('-v')
-        out, err, rc = libcxx.util.executeCommand(
-            cmd, input=libcxx.util.to_bytes('#error\n'))
+        cmd, probe = self._flagProbe('warning-flag', flag)
+        return self._cachedProbe('warning-flag', cmd, probe)
 
-        assert rc != 0
-        if flag in err:
-            return False
-        return True
+    def hasWarningFlags(self, flags):
+        """
+        hasWarningFlags - Return a list telling whether each of "flags" is
+        supported, as hasWarningFlag would, probing them as hasCompileFlags
+        does.
+        """
+        assert all(isinstance(f, str) and f.startswith('-W') for f in flags)
+        results = [None] * len(flags)
+        for kind, indices in [
+                ('compile-flag', [i for i, f in enumerate(flags)
+                                  if not f.startswith('-Wno-')]),
+                ('warning-flag', [i for i, f in enumerate(flags)
+                                  if f.startswith('-Wno-')])]:
+            if not indices:
+                continue
+            probed = self._probeFlags(kind, [flags[i] for i in indices])
+            for i, r in zip(indices, probed):
+                results[i] = r
+        return results
 
     def addWarningFlagIfSupported(self, flag):
         if self.hasWarningFlag(flag):
@@ -289,3 +787,10 @@ class CXXCompiler(object):
                 self.warning_flags += [flag]
             return True
         return False
+
+    def addWarningFlagsIfSupported(self, flags):
+        supported = self.hasWarningFlags(flags)
+        for flag, ok in zip(flags, supported):
+            if ok and flag not in self.warning_flags:
+                self.warning_flags += [flag]
+        return supported
@@ -0,0 +1,141 @@
+#===----------------------------------------------------------------------===##
+#
+#                     The LLVM Compiler Infrastructure
+#
+# This file is dual licensed under the MIT and the University of Illinois Open
+# Source Licenses. See LICENSE.TXT for details.
+#
+#===----------------------------------------------------------------------===##
+
+"""
+Support for building tests on one machine and running them on another.
+
+In the 'build' phase every .pass.cpp test is compiled into its own directory
+of the bundle, together with the data files it reads. The bundle also
+contains a POSIX shell script which runs each test in turn and prints its
+results between marker lines. In the 'run' phase the executor copies the
+whole bundle to the target once and runs that script, and the results are
+folded back into lit.
+"""
+
+import json
+import os
+import re
+import shutil
+
+try:
+    from shlex import quote as _shell_quote
+except ImportError:
+    from pipes import quote as _shell_quote
+
+import libcxx.util
+
+
+_runner_script = """\
+#!/bin/sh
+# Generated by the libc++ test format. Do not edit.
+%(env)s
+for dir in tests/*/; do
+  [ -d "$dir" ] || continue
+  id=$(basename "$dir")
+  attempts=$(cat "$dir/attempts")
+  n=0
+  while :; do
+    n=$((n + 1))
+    (cd "$dir" && ./test.exe >stdout 2>stderr)
+    rc=$?
+    if [ $rc -eq 0 ] || [ $n -ge $attempts ]; then
+      break
+    fi
+  done
+  echo "%(marker)s begin $id $rc $n"
+  cat "$dir/stdout"
+  echo
+  echo "%(marker)s stderr"
+  cat "$dir/stderr"
+  echo
+  echo "%(marker)s end"
+done
+"""
+
+_env_name_re = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+class TestBundle(object):
+    """
+    A directory of prebuilt tests which can be run without lit.
+    """
+
+    runner = 'run.sh'
+
+    def __init__(self, root):
+        self.root = root
+        self.results = None
+
+    def _path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def test_id(self, test):  # pylint: disable=no-self-use
+        return libcxx.util.hashData(test.getFullName())[:16]
+
+    def _read_marker(self):
+        with open(self._path('marker'), 'r') as f:
+            return f.read().strip()
+
+    def prepare(self, exec_env):
+        """Start a new bundle, discarding the tests of any previous build."""
+        shutil.rmtree(self._path('tests'), ignore_errors=True)
+        libcxx.util.cleanFile(self._path('results.json'))
+        libcxx.util.mkdir_p(self._path('tests'))
+        marker = '@@libcxx-bundle-%s@@' % libcxx.util.hashData(
+            self.root, repr(os.urandom(16)))[:16]
+        env = ['export %s=%s' % (k, _shell_quote(v))
+               for k, v in sorted(exec_env.items()) if _env_name_re.match(k)]
+        with open(self._path('marker'), 'w') as f:
+            f.write(marker + '\n')
+        with open(self._path(self.runner), 'w') as f:
+            f.write(_runner_script % {'env': '\n'.join(env),
+                                      'marker': marker})
+
+    def add(self, test, exec_path, data_files, attempts):
+        """Copy the test executable "exec_path" and its "data_files" into the
+        bundle. The test is run up to "attempts" times until it passes."""
+        test_dir = self._path('tests', self.test_id(test))
+        shutil.rmtree(test_dir, ignore_errors=True)
+        libcxx.util.mkdir_p(test_dir)
+        shutil.copy2(exec_path, os.path.join(test_dir, 'test.exe'))
+        for data_file in data_files:
+            shutil.copy2(data_file, test_dir)
+        with open(os.path.join(test_dir, 'attempts'), 'w') as f:
+            f.write('%d\n' % attempts)
+        with open(os.path.join(test_dir, 'name'), 'w') as f:
+            f.write(test.getFullName() + '\n')
+
+    def parse_output(self, out):
+        """Return the per test results printed by the runner script as a
+        dict mapping test ids to {'rc', 'attempts', 'out', 'err'}."""
+        marker = re.escape(self._read_marker())
+        result_re = re.compile(
+            r'^%s begin (\w+) (-?\d+) (\d+)\n(.*?)\n%s stderr\n(.*?)\n%s end$'
+            % (marker, marker, marker), re.MULTILINE | re.DOTALL)
+        results = {}
+        for m in result_re.finditer(out):
+            test_id, rc, attempts, test_out, test_err = m.groups()
+            results[test_id] = {'rc': int(rc), 'attempts': int(attempts),
+                                'out': test_out, 'err': test_err}
+        return results
+
+    def save_results(self, results):
+        libcxx.util.writeFileAtomic(self._path('results.json'),
+                                    json.dumps(results))
+
+    def result(self, test):
+        """Return the result recorded for "test" by the last run of the
+        bundle, or None if it was not run."""
+        if self.results is None:
+            try:
+                with open(self._path('results.json'), 'r') as f:
+                    self.results = json.load(f)
+            except (IOError, OSError, ValueError):
+                self.results = {}
+        return self.results.get(self.test_id(test))
@@ -7,22 +7,78 @@
 #
 #===----------------------------------------------------------------------===##
 
+import atexit
+import copy
+import json
 import locale
 import os
+import pickle
 import platform
 import pkgutil
 import pipes
 import re
 import shlex
 import shutil
+import stat
+import subprocess
 import sys
+import time
 
+from libcxx.cache import CompileCache, PersistentCache
+from libcxx.cache import fingerprintFiles, fingerprintsMatch
 from libcxx.compiler import CXXCompiler
 from libcxx.test.target_info import make_target_info
 from libcxx.test.executor import *
+from libcxx.test.failfast import FailureLimit
+from libcxx.test.bundle import TestBundle
+from libcxx.test.discovery import DiscoveryManifest
+from libcxx.test.metadata import TestMetadataIndex
+from libcxx.test.result_cache import TestResultCache
+from libcxx.test.timings import TestHistory, TestTimings
+from libcxx.test.selection import DependencyIndex, git_changed_files
+from libcxx.test.selection import normalize_path
+from libcxx.test.stats import RunStatistics
+from libcxx.test.steps import StepGraph, default_jobs
 from libcxx.test.tracing import *
+import libcxx.compiler
+import libcxx.test.target_info
 import libcxx.util
 
+def _snapshot(attrs):
+    # Copy the containers which may be updated in place.
+    return dict((k, copy.copy(v) if isinstance(v, (list, dict, set)) else v)
+                for k, v in attrs.items())
+
+
+def _changed(attrs, snapshot):
+    # Return the attributes which differ from "snapshot".
+    changed = {}
+    for k, v in attrs.items():
+        if k not in snapshot:
+            changed[k] = v
+        elif isinstance(v, (list, dict, set)):
+            if snapshot[k] != v:
+                changed[k] = v
+        elif snapshot[k] is not v:
+            changed[k] = v
+    return changed
+
+
+# The environment variables read by configure_toolchain(), besides those
+# starting with LIBCXX_ or LIT_.
+_config_env_vars = ['PATH', 'INCLUDE', 'LIB', 'CPATH', 'C_INCLUDE_PATH',
+                    'CPLUS_INCLUDE_PATH', 'OBJC_INCLUDE_PATH', 'LIBRARY_PATH',
+                    'COMPILER_PATH', 'GCC_EXEC_PREFIX', 'SDKROOT',
+                    'MACOSX_DEPLOYMENT_TARGET', 'IPHONEOS_DEPLOYMENT_TARGET',
+                    'LD_LIBRARY_PATH', 'DYLD_LIBRARY_PATH', 'CCACHE_CPP2']
+
+
+def _environment_changes(env):
+    # Return the variables of "env" which differ from those lit was started
+    # with.
+    return dict((k, v) for k, v in env.items() if os.environ.get(k) != v)
+
+
 def loadSiteConfig(lit_config, config, param_name, env_name):
     # We haven't loaded the site specific configuration (the user is
     # probably trying to run on a test file directly, and either the site
@@ -52,9 +108,12 @@ def loadSiteConfig(lit_config, config, param_name, env_name):
 
 class Configuration(object):
     # pylint: disable=redefined-outer-name
-    def __init__(self, lit_config, config):
+    def __init__(self, lit_config, config, parent=None):
         self.lit_config = lit_config
         self.config = config
+        # The configuration this one is a matrix entry of, if any.
+        self.parent = parent
+        self.variants = []
         self.is_windows = platform.system() == 'Windows'
         self.cxx = None
         self.cxx_is_clang_cl = None
@@ -62,6 +121,8 @@ class Configuration(object):
         self.project_obj_root = None
         self.libcxx_src_root = None
         self.libcxx_obj_root = None
+        self.cxx_headers = None
+        self.module_cache = None
         self.cxx_library_root = None
         self.cxx_runtime_root = None
         self.abi_library_root = None
@@ -73,6 +134,26 @@ class Configuration(object):
         self.use_clang_verify = False
         self.long_tests = None
         self.execute_external = False
+        self.run_stats = None
+        self.run_summaries = []
+        self.result_cache = None
+        self.unity_batch_size = 0
+        self.phase_slots = {}
+        self.probe_cache = None
+        self.dep_index = None
+        self.metadata_index = None
+        self.manifest = None
+        self.timings = None
+        self.memory_history = None
+        self.memory_budget = None
+        self.trace_file = None
+        self.failure_limit = None
+        self.jobserver = None
+        self.config_cache_file = None
+        self.step_timings = []
+        self.changed_files = None
+        self.bundle = None
+        self.bundle_phase = None
 
     def get_lit_conf(self, name, default=None):
         val = self.lit_config.params.get(name, None)
@@ -122,34 +203,96 @@ class Configuration(object):
             return 'lib' + name + '.a'
 
     def configure(self):
-        self.configure_executor()
-        self.configure_use_system_cxx_lib()
-        self.configure_target_info()
-        self.configure_cxx()
-        self.configure_triple()
-        self.configure_deployment()
-        self.configure_availability()
-        self.configure_src_root()
-        self.configure_obj_root()
-        self.configure_cxx_stdlib_under_test()
-        self.configure_cxx_library_root()
-        self.configure_use_clang_verify()
-        self.configure_use_thread_safety()
-        self.configure_execute_external()
-        self.configure_ccache()
-        self.configure_compile_flags()
-        self.configure_filesystem_compile_flags()
-        self.configure_link_flags()
-        self.configure_env()
-        self.configure_color_diagnostics()
-        self.configure_debug_mode()
-        self.configure_warnings()
-        self.configure_sanitizer()
-        self.configure_coverage()
-        self.configure_modules()
-        self.configure_coroutines()
-        self.configure_substitutions()
-        self.configure_features()
+        # The state of the lit config before it is configured, from which
+        # the configurations of a matrix run start.
+        self.initial_state = (set(self.config.available_features),
+                              list(self.config.substitutions),
+                              dict(self.config.environment))
+        steps = StepGraph()
+        steps.add('run_statistics', self.configure_run_statistics)
+        steps.add('executor', self.configure_executor)
+        steps.add('target_info', self.configure_target_info)
+        steps.add('probe_cache', self.configure_probe_cache)
+        steps.add('toolchain', self.configure_cached_toolchain)
+        # Checking a locale switches the locale of the whole process, so it
+        # is done here, on the main thread, once no other step is running.
+        steps.add('locales', self.configure_locales)
+        steps.add('module_prebuild', self.configure_module_prebuild)
+        steps.add('pch', self.configure_pch)
+        steps.add('bundle', self.configure_bundle)
+        steps.add('result_cache', self.configure_result_cache)
+        steps.add('compile_cache', self.configure_compile_cache)
+        steps.add('test_selection', self.configure_test_selection)
+        steps.add('metadata_index', self.configure_metadata_index)
+        steps.add('discovery', self.configure_discovery)
+        steps.add('timings', self.configure_timings)
+        steps.add('memory_budget', self.configure_memory_budget)
+        steps.add('trace', self.configure_trace)
+        steps.add('failure_limit', self.configure_failure_limit)
+        steps.add('unity_build', self.configure_unity_build)
+        steps.add('phase_slots', self.configure_phase_slots)
+        steps.add('jobserver', self.configure_jobserver)
+        steps.add('matrix', self.configure_matrix)
+        self.step_timings += steps.run()
+
+    def configure_cached_toolchain(self):
+        if self.load_config_cache():
+            return
+        state = self.snapshot_state()
+        self.configure_toolchain()
+        self.save_config_cache(state)
+
+    def configure_toolchain(self):
+        # Everything done here only depends on the inputs hashed by
+        # config_cache_key(), so its result is saved in the configuration
+        # cache.
+        #
+        # The steps changing the compiler flags run one after the other, in
+        # a fixed order, so that the flags and the commands probing the
+        # compiler are the same on every run. The steps which only probe
+        # the compiler once its flags are known run concurrently.
+        jobs = self.get_lit_conf('configure_jobs', str(default_jobs))
+        try:
+            jobs = int(jobs)
+        except ValueError:
+            self.lit_config.fatal('configure_jobs must be an integer: %r'
+                                  % jobs)
+        steps = StepGraph(jobs)
+        steps.add('use_system_cxx_lib', self.configure_use_system_cxx_lib)
+        steps.add('cxx', self.configure_cxx)
+        steps.add('triple', self.configure_triple)
+        steps.add('deployment', self.configure_deployment)
+        steps.add('availability', self.configure_availability)
+        steps.add('src_root', self.configure_src_root)
+        steps.add('obj_root', self.configure_obj_root)
+        steps.add('cxx_stdlib_under_test',
+                  self.configure_cxx_stdlib_under_test)
+        steps.add('cxx_library_root', self.configure_cxx_library_root)
+        steps.add('use_clang_verify', self.configure_use_clang_verify)
+        steps.add('use_thread_safety', self.configure_use_thread_safety)
+        steps.add('execute_external', self.configure_execute_external)
+        steps.add('ccache', self.configure_ccache)
+        steps.add('cc1', self.configure_cc1)
+        steps.add('compile_flags', self.configure_compile_flags)
+        steps.add('filesystem_compile_flags',
+                  self.configure_filesystem_compile_flags)
+        steps.add('link_flags', self.configure_link_flags)
+        steps.add('env', self.configure_env)
+        steps.add('color_diagnostics', self.configure_color_diagnostics)
+        steps.add('debug_mode', self.configure_debug_mode)
+        steps.add('warnings', self.configure_warnings)
+        steps.add('sanitizer', self.configure_sanitizer)
+        steps.add('coverage', self.configure_coverage)
+        steps.add('modules', self.configure_modules)
+        # Enabling modules changes the commands of the later probes.
+        probes_after = ['modules'] if self.get_modules_enabled() \
+                       else ['coverage']
+        steps.add('coroutines', self.configure_coroutines,
+                  after=probes_after)
+        steps.add('features', self.configure_features, after=probes_after)
+        steps.add('substitutions', self.configure_substitutions,
+                  after=['modules', 'coroutines', 'features'])
+        self.step_timings += steps.run()
 
     def print_config_info(self):
         # Print the final compile and link flags.
@@ -158,6 +301,8 @@ class Configuration(object):
         if self.cxx.use_modules:
             self.lit_config.note('Using modules flags: %s' %
                                  self.cxx.modules_flags)
+        if self.cxx.use_pch:
+            self.lit_config.note('Using PCH flags: %s' % self.cxx.pch_flags)
         self.lit_config.note('Using compile flags: %s'
                              % self.cxx.compile_flags)
         if len(self.cxx.warning_flags):
@@ -171,6 +316,11 @@ class Configuration(object):
             if k not in os.environ or os.environ[k] != v:
                 show_env_vars[k] = v
         self.lit_config.note('Adding environment variables: %r' % show_env_vars)
+        slowest = sorted(self.step_timings, key=lambda t: t[1], reverse=True)
+        self.lit_config.note('Configuration steps taking over 1ms: %s' %
+                             ', '.join('%s %dms' % (name, elapsed * 1000)
+                                       for name, elapsed in slowest
+                                       if elapsed >= 0.001))
         sys.stderr.flush()  # Force flushing to avoid broken output on Windows
 
     def get_test_format(self):
@@ -180,7 +330,55 @@ class Configuration(object):
             self.use_clang_verify,
             self.execute_external,
             self.executor,
-            exec_env=self.exec_env)
+            exec_env=self.exec_env,
+            result_cache=self.result_cache,
+            run_stats=self.run_stats,
+            unity_batch_size=self.unity_batch_size,
+            phase_slots=self.phase_slots,
+            bundle=self.bundle,
+            bundle_phase=self.bundle_phase,
+            dep_index=self.dep_index,
+            changed_files=self.changed_files,
+            metadata_index=self.metadata_index,
+            timings=self.timings,
+            memory_history=self.memory_history,
+            memory_budget=self.memory_budget,
+            trace=self.trace_file is not None,
+            failure_limit=self.failure_limit,
+            variants=self.variants,
+            base_features=self.config.available_features,
+            jobserver=self.jobserver,
+            manifest=self.manifest)
+
+    def configure_run_statistics(self):
+        # State shared by the worker processes of this run lives in a
+        # directory which is removed once lit exits. Events recorded by the
+        # test format are summarized at that point. The worker processes
+        # never run the atexit handlers.
+        if self.parent is not None:
+            self.run_dir = self.parent.run_dir
+            self.run_stats = self.parent.run_stats
+            return
+        self.run_dir = os.path.join(self.config.test_exec_root,
+                                    'run.%d' % os.getpid())
+        if os.path.isdir(self.run_dir):
+            shutil.rmtree(self.run_dir)
+        self.run_stats = RunStatistics(os.path.join(self.run_dir,
+                                                    'stats.json'))
+        atexit.register(self.print_run_summary)
+        self.run_summaries += [self.summarize_etxtbsy_retries]
+
+    def summarize_etxtbsy_retries(self):
+        retries = self.run_stats.count('etxtbsy-retry')
+        if retries:
+            self.lit_config.note('retried running %d test executables which '
+                                 'were busy (ETXTBSY)' % retries)
+
+    def print_run_summary(self):
+        for summarize in self.run_summaries:
+            summarize()
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        sys.stderr.flush()
 
     def configure_executor(self):
         exec_str = self.get_lit_conf('executor', "None")
@@ -225,7 +423,8 @@ class Configuration(object):
         if not cxx:
             self.lit_config.fatal('must specify user parameter cxx_under_test '
                                   '(e.g., --param=cxx_under_test=clang++)')
-        self.cxx = CXXCompiler(cxx) if not self.cxx_is_clang_cl else \
+        self.cxx = CXXCompiler(cxx, probe_cache=self.probe_cache) \
+                   if not self.cxx_is_clang_cl else \
                    self._configure_clang_cl(cxx)
         cxx_type = self.cxx.type
         if cxx_type is not None:
@@ -241,6 +440,137 @@ class Configuration(object):
         # comments.
         self.cxx.compile_env['CCACHE_CPP2'] = '1'
 
+    def configure_probe_cache(self):
+        # Remember which flags the compiler supports, and what it reports
+        # about itself, across runs. Entries are
+        # keyed by the contents of the compiler binary and the full probe
+        # command, so they never need to be invalidated by hand.
+        if not self.get_lit_bool('probe_cache', True):
+            return
+        self.probe_cache = PersistentCache(
+            os.path.join(self.config.test_exec_root, 'probe.cache'))
+
+    def config_cache_key(self):
+        # Everything configure_toolchain() reads: the lit parameters, the
+        # settings of the site configuration, the executor, the environment,
+        # the compiler binary and the __config_site header, and the code
+        # doing the configuration itself. The library binaries are only known once
+        # configured; they are checked by load_config_cache().
+        settings = []
+        for name, value in sorted(vars(self.config).items()):
+            if value is None or isinstance(value, (str, bool, int, float)):
+                settings += [name, repr(value)]
+            elif isinstance(value, (list, tuple)) and \
+                    all(isinstance(v, str) for v in value):
+                settings += [name, repr(list(value))]
+        # Only the variables read while configuring; others, such as
+        # MAKEFLAGS, change from one invocation to the next.
+        environments = [sorted((k, v) for k, v in env.items()
+                               if k in _config_env_vars or
+                               k.startswith(('LIBCXX_', 'LIT_')))
+                        for env in (os.environ, self.config.environment)]
+        parts = [sys.version,
+                 repr(sorted(self.lit_config.params.items())), settings,
+                 repr(sorted(self.config.available_features)),
+                 repr(self.executor), repr(environments)]
+        cxx = self.get_lit_conf('cxx_under_test') or 'clang++'
+        exe = libcxx.util.which(cxx, self.config.environment.get('PATH'))
+        obj_root = self.get_lit_conf('libcxx_obj_root')
+        inputs = [os.path.realpath(exe) if exe else cxx]
+        if obj_root:
+            inputs += [os.path.join(obj_root, '__config_site')]
+        inputs += [os.path.splitext(m.__file__)[0] + '.py'
+                   for m in (sys.modules[__name__], libcxx.compiler,
+                             libcxx.test.target_info)]
+        for path in inputs:
+            try:
+                st = os.stat(path)
+            except OSError:
+                parts += [path, 'missing']
+                continue
+            parts += [path, str(st.st_size), repr(st.st_mtime)]
+        return libcxx.util.hashData(*parts)
+
+    def snapshot_state(self):
+        return (_snapshot(vars(self)), _snapshot(vars(self.config)))
+
+    def save_config_cache(self, state):
+        # Save what configure_toolchain() changed in this object and in the
+        # lit config, compared to the snapshot "state" taken before it ran.
+        if self.config_cache_file is None:
+            return
+        changed = _changed(vars(self), state[0])
+        changed.pop('exec_env', None)
+        changed.pop('step_timings', None)
+        changed_config = _changed(vars(self.config), state[1])
+        changed_config.pop('environment', None)
+        # The environments are saved as the changes made to the one lit was
+        # started with, and applied to that of the run using the cache.
+        config_env = dict((k, v) for k, v in self.config.environment.items()
+                          if state[1]['environment'].get(k) != v)
+        exec_env = _environment_changes(self.exec_env)
+        compile_env = _environment_changes(self.cxx.compile_env)
+        roots = self.get_cxx_library_roots()
+        libraries = fingerprintFiles(self.get_cxx_library_files(roots))
+        if libraries is None:
+            return
+        probe_cache = self.cxx.probe_cache
+        saved_compile_env = self.cxx.compile_env
+        self.cxx.probe_cache = None
+        self.cxx.compile_env = None
+        try:
+            data = pickle.dumps({'attrs': changed, 'config': changed_config,
+                                 'config_env': config_env,
+                                 'exec_env': exec_env,
+                                 'compile_env': compile_env,
+                                 'library_roots': roots,
+                                 'libraries': libraries},
+                                pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return
+        finally:
+            self.cxx.probe_cache = probe_cache
+            self.cxx.compile_env = saved_compile_env
+        try:
+            libcxx.util.writeFileAtomic(self.config_cache_file, data)
+        except (IOError, OSError):
+            pass
+
+    def load_config_cache(self):
+        # Restore the result of configure_toolchain() from a previous run
+        # with the same inputs, unless asked to probe the compiler again.
+        if not self.get_lit_bool('config_cache', False):
+            return False
+        path = os.path.join(self.config.test_exec_root, 'config.cache',
+                            self.config_cache_key() + '.pickle')
+        self.config_cache_file = path
+        if self.get_lit_bool('reconfigure', False):
+            return False
+        try:
+            with open(path, 'rb') as f:
+                saved = pickle.load(f)
+        except Exception:
+            return False
+        # The libraries decide which link flags and features are used.
+        libraries = saved['libraries']
+        if [l[0] for l in libraries] != \
+                self.get_cxx_library_files(saved['library_roots']) or \
+                not fingerprintsMatch(libraries):
+            return False
+        vars(self).update(saved['attrs'])
+        vars(self.config).update(saved['config'])
+        self.config.environment.update(saved['config_env'])
+        self.exec_env.update(saved['exec_env'])
+        self.cxx.compile_env = dict(os.environ)
+        self.cxx.compile_env.update(saved['compile_env'])
+        self.cxx.probe_cache = self.probe_cache
+        if 'modules-support' in self.config.available_features:
+            self.configure_module_cache()
+        if 'c++filesystem' in self.config.available_features:
+            self.make_filesystem_dynamic_env()
+        self.lit_config.note('using cached configuration %s' % path)
+        return True
+
     def _configure_clang_cl(self, clang_path):
         def _split_env_var(var):
             return [p.strip() for p in os.environ.get(var, '').split(';') if p.strip()]
@@ -257,7 +587,8 @@ class Configuration(object):
             self.add_path(self.exec_env, path)
         return CXXCompiler(clang_path, flags=flags,
                            compile_flags=compile_flags,
-                           link_flags=link_flags)
+                           link_flags=link_flags,
+                           probe_cache=self.probe_cache)
 
     def _dump_macros_verbose(self, *args, **kwargs):
         macros_or_error = self.cxx.dumpMacros(*args, **kwargs)
@@ -312,6 +643,30 @@ class Configuration(object):
         self.lit_config.note(
             "inferred with_availability as: %r" % self.with_availability)
 
+    def get_cxx_library_roots(self):
+        """Return the directories of the libc++ and ABI libraries."""
+        roots = [self.cxx_library_root, self.abi_library_root]
+        if self.use_system_cxx_lib and \
+                os.path.isdir(str(self.use_system_cxx_lib)):
+            roots += [self.use_system_cxx_lib]
+        return roots
+
+    def get_cxx_library_files(self, roots=None):
+        """Return the libc++ and ABI library binaries the tests link
+        against."""
+        if roots is None:
+            roots = self.get_cxx_library_roots()
+        files = []
+        for root in roots:
+            if not root or not os.path.isdir(root):
+                continue
+            for name in sorted(os.listdir(root)):
+                path = os.path.join(root, name)
+                if (name.startswith('libc++') or name.startswith('c++')) \
+                        and os.path.isfile(path):
+                    files += [path]
+        return files
+
     def configure_cxx_stdlib_under_test(self):
         self.cxx_stdlib_under_test = self.get_lit_conf(
             'cxx_stdlib_under_test', 'libc++')
@@ -376,18 +731,419 @@ class Configuration(object):
             self.cxx.use_ccache = True
             self.lit_config.note('enabling ccache')
 
+    def configure_cc1(self):
+        if not self.get_lit_bool('use_cc1', False):
+            return
+        if self.cxx.type not in ['clang', 'apple-clang'] or self.is_windows:
+            self.lit_config.warning('use_cc1 is only supported with clang on '
+                                    'non-Windows hosts')
+            return
+        if self.cxx.use_ccache:
+            self.lit_config.warning('use_cc1 has no effect with ccache')
+            return
+        self.cxx.useCC1()
+        self.lit_config.note('invoking the clang frontend and linker '
+                             'directly')
+
+    def configure_result_cache(self):
+        use_result_cache = self.get_lit_bool('result_cache', False)
+        if not use_result_cache:
+            return
+        cache_root = os.path.join(self.config.test_exec_root, 'result.cache')
+        self.result_cache = TestResultCache(cache_root,
+                                            self.get_cxx_library_files())
+        self.run_summaries += [self.summarize_result_cache]
+        self.lit_config.note('using result cache at %s' % cache_root)
+
+    def summarize_result_cache(self):
+        hits = self.run_stats.count('result-cache', hit=True)
+        misses = self.run_stats.count('result-cache', hit=False)
+        if hits or misses:
+            self.lit_config.note('result cache: %d hits, %d misses'
+                                 % (hits, misses))
+
+    def configure_bundle(self):
+        bundle_dir = self.get_lit_conf('bundle_dir')
+        if not bundle_dir:
+            return
+        phase = self.get_lit_conf('bundle_phase', 'build')
+        if phase not in ('build', 'run'):
+            self.lit_config.fatal("bundle_phase must be 'build' or 'run': %r"
+                                  % phase)
+        self.bundle = TestBundle(os.path.abspath(bundle_dir))
+        self.bundle_phase = phase
+        if phase == 'build':
+            # Only the variables set up for the tests are exported; the rest
+            # of this environment means nothing on the target.
+            self.bundle.prepare(dict(
+                (k, v) for k, v in self.exec_env.items()
+                if k not in os.environ or os.environ[k] != v))
+            self.lit_config.note('building pass tests into the test bundle '
+                                 'at %s' % self.bundle.root)
+            return
+        # Run every test of the bundle with a single command on the target
+        # before lit starts; the test format then only reports the results.
+        self.lit_config.note('running the test bundle at %s'
+                             % self.bundle.root)
+        if not os.path.isfile(os.path.join(self.bundle.root,
+                                           TestBundle.runner)):
+            self.lit_config.fatal('no test bundle found at %s; build one '
+                                  'with bundle_phase=build first'
+                                  % self.bundle.root)
+        try:
+            cmd, out, err, rc = self.executor.run_bundle(self.bundle.root,
+                                                         TestBundle.runner)
+        except NotImplementedError:
+            self.lit_config.fatal('the executor %r cannot run test bundles'
+                                  % self.executor)
+        if rc != 0:
+            self.lit_config.fatal('running the test bundle failed:\n%s'
+                                  % libcxx.util.makeReport(cmd, out, err, rc))
+        self.bundle.save_results(self.bundle.parse_output(out))
+
+    def configure_compile_cache(self):
+        # Matrix entries often compile a test with the same command.
+        default = bool(self.get_lit_conf('matrix'))
+        if not self.get_lit_bool('compile_cache', default):
+            return
+        size = self.get_lit_conf('compile_cache_size', '2048')
+        try:
+            size = int(size)
+        except ValueError:
+            self.lit_config.fatal('compile_cache_size must be an integer: %r'
+                                  % size)
+        cache_root = os.path.join(self.config.test_exec_root, 'compile.cache')
+        self.cxx.compile_cache = CompileCache(cache_root, size * 1024 * 1024,
+                                              stats=self.run_stats)
+        self.run_summaries += [self.summarize_compile_cache]
+        self.lit_config.note('using compile cache at %s' % cache_root)
+
+    def summarize_compile_cache(self):
+        hits = self.run_stats.count('compile-cache', hit=True)
+        misses = self.run_stats.count('compile-cache', hit=False)
+        evicted = self.cxx.compile_cache.evict()
+        if hits or misses:
+            self.lit_config.note('compile cache: %d hits, %d misses (%.0f%%), '
+                                 '%d entries evicted'
+                                 % (hits, misses,
+                                    100.0 * hits / (hits + misses), evicted))
+
+    def configure_test_selection(self):
+        # Record the files each compiled test depends on, so that a later run
+        # can select the tests affected by a change. Asking the compiler for
+        # them changes every compile command, so by default this is only done
+        # when selecting tests.
+        changed_files = self.get_lit_conf('changed_files')
+        changed_since = self.get_lit_conf('changed_since')
+        selecting = changed_files is not None or changed_since is not None
+        if not self.get_lit_bool('dependency_index', selecting):
+            return
+        index_root = os.path.join(self.config.test_exec_root, 'dep.index')
+        self.dep_index = DependencyIndex(index_root)
+        if not selecting:
+            return
+        changed = []
+        if changed_files:
+            changed += [os.path.abspath(f)
+                        for f in changed_files.split(os.pathsep) if f]
+        if changed_since:
+            try:
+                changed += git_changed_files(self.libcxx_src_root,
+                                             changed_since)
+            except subprocess.CalledProcessError as e:
+                self.lit_config.fatal('cannot list the files changed since '
+                                      '%r:\n%s' % (changed_since, e.output))
+        # Tests only record the headers and data files they read. Changes
+        # to the library sources or to the test harness itself can affect
+        # any test.
+        untracked_roots = [os.path.join(self.libcxx_src_root, d)
+                           for d in ('src', 'utils', 'lib')]
+        for f in changed:
+            name = os.path.basename(f)
+            if any(f.startswith(r + os.sep) for r in untracked_roots) or \
+                    name.startswith('lit.') or name == 'CMakeLists.txt':
+                self.lit_config.note('%s may affect every test; not '
+                                     'selecting tests' % f)
+                return
+        self.changed_files = set(normalize_path(f) for f in changed)
+        self.run_summaries += [self.summarize_test_selection]
+        self.lit_config.note('selecting the tests affected by %d changed '
+                             'files' % len(self.changed_files))
+
+    def summarize_test_selection(self):
+        events = self.run_stats.events('selection')
+        selected = sum(e['selected'] for e in events)
+        skipped = sum(e['skipped'] for e in events)
+        self.lit_config.note('test selection: %d tests selected, %d skipped '
+                             'as unaffected' % (selected, skipped))
+
+    def configure_metadata_index(self):
+        # Remember the lit keywords and other facts read from each test
+        # across runs. Without it they are only remembered in each process.
+        if not self.get_lit_bool('metadata_index', True):
+            return
+        self.metadata_index = TestMetadataIndex(
+            os.path.join(self.config.test_exec_root, 'metadata.index'))
+
+    def configure_discovery(self):
+        # Share the listings of the test directories made during discovery
+        # with the worker processes.
+        self.manifest = DiscoveryManifest(
+            os.path.join(self.config.test_exec_root, 'discovery.index'))
+
+    def configure_timings(self):
+        # Record how long each test takes and use it to start the slowest
+        # tests first on the next run.
+        if not self.get_lit_bool('schedule_by_time', True):
+            return
+        self.timings = TestTimings(os.path.join(self.config.test_exec_root,
+                                                'test-times.json'))
+        self.run_summaries += [self.summarize_timings]
+
+    def summarize_timings(self):
+        times = dict((e['name'], e['elapsed'])
+                     for e in self.run_stats.events('test-usage'))
+        if times:
+            self.timings.update(times)
+
+    def configure_memory_budget(self):
+        # With a budget, record the peak memory used by the commands of each
+        # test, and only start a test once the memory it used in previous
+        # runs fits next to that of the tests already running.
+        budget = self.get_lit_conf('memory_budget')
+        if not budget:
+            return
+        try:
+            budget = int(budget)
+        except ValueError:
+            budget = 0
+        if budget <= 0:
+            self.lit_config.fatal('memory_budget must be a positive number '
+                                  'of MiB: %r'
+                                  % self.get_lit_conf('memory_budget'))
+        if not hasattr(os, 'wait4'):
+            self.lit_config.warning('memory_budget is not supported on this '
+                                    'platform')
+            return
+        self.memory_history = TestHistory(
+            os.path.join(self.config.test_exec_root, 'test-memory.json'))
+        self.run_summaries += [self.summarize_memory]
+        self.memory_budget = libcxx.util.MemoryBudget(
+            os.path.join(self.run_dir, 'memory'), budget * 1024 * 1024)
+        self.lit_config.note('limiting the memory of concurrent tests to '
+                             '%d MiB' % budget)
+
+    def summarize_memory(self):
+        usage = dict((e['name'], e['max_rss'])
+                     for e in self.run_stats.events('test-usage')
+                     if e.get('max_rss'))
+        if usage:
+            self.memory_history.update(usage)
+
+    def configure_trace(self):
+        # Record where the time of each test goes: parsing, compiling,
+        # linking, copying to the target, running and cleaning up.
+        trace_file = self.get_lit_conf('trace_file')
+        if not trace_file:
+            return
+        self.trace_file = os.path.abspath(trace_file)
+        self.run_summaries += [self.summarize_trace]
+
+    def summarize_trace(self):
+        spans = self.run_stats.events('span')
+        if not spans:
+            return
+        write_chrome_trace(self.trace_file, spans)
+        self.lit_config.note('wrote %d trace spans to %s\n%s'
+                             % (len(spans), self.trace_file,
+                                format_span_summary(spans)))
+
+    def configure_failure_limit(self):
+        # Stop compiling and running tests once too many have failed, and
+        # kill the commands of the tests still in progress.
+        max_failures = self.get_lit_conf('max_failures')
+        max_rate = self.get_lit_conf('max_failure_rate')
+        if not max_failures and not max_rate:
+            return
+        if max_failures:
+            try:
+                max_failures = int(max_failures)
+            except ValueError:
+                max_failures = 0
+            if max_failures <= 0:
+                self.lit_config.fatal('max_failures must be a positive '
+                                      'integer: %r'
+                                      % self.get_lit_conf('max_failures'))
+        else:
+            max_failures = None
+        if max_rate:
+            try:
+                max_rate = float(max_rate)
+            except ValueError:
+                max_rate = 0
+            if not 0 < max_rate < 1:
+                self.lit_config.fatal('max_failure_rate must be between 0 and '
+                                      '1: %r'
+                                      % self.get_lit_conf('max_failure_rate'))
+        else:
+            max_rate = None
+        self.failure_limit = FailureLimit(os.path.join(self.run_dir,
+                                                       'failures'),
+                                          max_failures=max_failures,
+                                          max_rate=max_rate)
+        self.run_summaries += [self.summarize_failure_limit]
+
+    def summarize_failure_limit(self):
+        if self.failure_limit.reached():
+            self.lit_config.warning('the run was stopped after %d failures; '
+                                    'the remaining tests were skipped'
+                                    % self.failure_limit.failures())
+
+    def configure_unity_build(self):
+        unity_build = self.get_lit_bool('unity_build', False)
+        if not unity_build:
+            return
+        if self.cxx.use_modules:
+            self.lit_config.warning('unity_build cannot be combined with '
+                                    'modules')
+            return
+        if self.bundle_phase is not None:
+            self.lit_config.warning('unity_build cannot be combined with '
+                                    'test bundles')
+            return
+        # Tests are turned into lambdas, which only Clang accepts (as an
+        # extension) before C++11.
+        if self.cxx.type == 'gcc' and \
+                self.config.available_features.intersection(['c++98',
+                                                             'c++03']):
+            self.lit_config.warning('unity_build requires C++11 with GCC')
+            return
+        batch_size = self.get_lit_conf('unity_batch_size', '16')
+        try:
+            self.unity_batch_size = int(batch_size)
+        except ValueError:
+            self.lit_config.fatal('unity_batch_size must be an integer: %r'
+                                  % batch_size)
+        self.run_summaries += [self.summarize_unity_build]
+        self.lit_config.note('using unity builds of up to %d tests'
+                             % self.unity_batch_size)
+
+    def summarize_unity_build(self):
+        built = self.run_stats.count('unity-build', ok=True)
+        failed = self.run_stats.count('unity-build', ok=False)
+        if built or failed:
+            self.lit_config.note('unity build: %d batches built, %d fell back '
+                                 'to individual builds' % (built, failed))
+
+    def configure_phase_slots(self):
+        # Limit how many tests may be compiling, and how many may be running,
+        # at the same time. Running lit with more workers than either limit
+        # lets tests that have finished compiling queue for an execution
+        # slot while others keep the compilers busy.
+        for phase, param in [('compile', 'compile_jobs'),
+                             ('execute', 'exec_jobs')]:
+            jobs = self.get_lit_conf(param)
+            if not jobs:
+                continue
+            try:
+                jobs = int(jobs)
+            except ValueError:
+                jobs = 0
+            if jobs <= 0:
+                self.lit_config.fatal('%s must be a positive integer: %r'
+                                      % (param, self.get_lit_conf(param)))
+            self.phase_slots[phase] = libcxx.util.FileSemaphore(
+                os.path.join(self.run_dir, '%s.slots' % phase), jobs)
+            self.lit_config.note('limiting the %s phase to %d concurrent '
+                                 'tests' % (phase, jobs))
+
+    def configure_jobserver(self):
+        # When lit is run by make, count the compile and execute steps of
+        # the tests against the jobs of the whole build.
+        if not self.get_lit_bool('use_jobserver', False):
+            return
+        auth = libcxx.util.parseJobServerAuth(os.environ.get('MAKEFLAGS', ''))
+        if auth is None or self.is_windows:
+            self.lit_config.warning('use_jobserver: no jobserver found in '
+                                    'MAKEFLAGS; not limiting the tests')
+            return
+        if auth[0] == 'fds':
+            # make only leaves the pipe open for the commands of recursive
+            # rules; otherwise the descriptors may belong to other files.
+            try:
+                is_pipe = all(stat.S_ISFIFO(os.fstat(fd).st_mode)
+                              for fd in auth[1:])
+            except OSError:
+                is_pipe = False
+            if not is_pipe:
+                self.lit_config.warning(
+                    'use_jobserver: the jobserver pipe is not open; mark the '
+                    'rule running lit as recursive (prefix it with "+")')
+                return
+        self.jobserver = libcxx.util.JobServer(
+            auth, os.path.join(self.run_dir, 'jobserver'))
+        self.lit_config.note('sharing the jobs of the make jobserver')
+
+    def configure_matrix(self):
+        # Run every test once in each entry of the matrix, for instance
+        # "std=c++11;std=c++14;std=c++17,enable_exceptions=False". Each entry
+        # overrides some of the parameters of this configuration.
+        matrix = self.get_lit_conf('matrix')
+        if not matrix or self.parent is not None:
+            return
+        if self.bundle is not None or self.unity_batch_size:
+            self.lit_config.fatal('matrix cannot be combined with bundle_dir '
+                                  'or unity_build')
+        for entry in matrix.split(';'):
+            entry = entry.strip()
+            if not entry:
+                continue
+            overrides = {}
+            for item in entry.split(','):
+                key, sep, value = item.partition('=')
+                if not sep or not key.strip():
+                    self.lit_config.fatal(
+                        'invalid matrix entry %r: expected comma separated '
+                        'name=value pairs' % entry)
+                overrides[key.strip()] = value.strip()
+            self.variants += [self.make_variant(entry, overrides)]
+        self.lit_config.note('running each test in %d configurations'
+                             % len(self.variants))
+
+    def make_variant(self, name, overrides):
+        from libcxx.test.format import TestVariant
+        lit_config = copy.copy(self.lit_config)
+        lit_config.params = dict(self.lit_config.params)
+        lit_config.params.update(overrides)
+        # Only report what this configuration does once.
+        lit_config.note = lambda message: None
+        config = copy.copy(self.config)
+        features, substitutions, environment = self.initial_state
+        config.available_features = set(features)
+        config.substitutions = list(substitutions)
+        config.environment = dict(environment)
+        variant = self.__class__(lit_config, config, parent=self)
+        variant.configure()
+        self.lit_config.note('matrix entry %s: using flags %s'
+                             % (name, variant.cxx.flags +
+                                variant.cxx.compile_flags))
+        return TestVariant(name, variant.get_test_format(),
+                           config.available_features)
+
     def add_deployment_feature(self, feature):
         (arch, name, version) = self.config.deployment
         self.config.available_features.add('%s=%s-%s' % (feature, arch, name))
         self.config.available_features.add('%s=%s' % (feature, name))
         self.config.available_features.add('%s=%s%s' % (feature, name, version))
 
+    def configure_locales(self):
+        self.target_info.add_locale_features(self.config.available_features)
+
     def configure_features(self):
         additional_features = self.get_lit_conf('additional_features')
         if additional_features:
             for f in additional_features.split(','):
                 self.config.available_features.add(f.strip())
-        self.target_info.add_locale_features(self.config.available_features)
 
         target_platform = self.target_info.platform()
 
@@ -438,19 +1194,24 @@ class Configuration(object):
         if self.long_tests:
             self.config.available_features.add('long_tests')
 
+        has_sized_dealloc, has_aligned_alloc, has_delayed_parsing = \
+            self.cxx.hasCompileFlags(['-fsized-deallocation',
+                                      '-faligned-allocation',
+                                      '-fdelayed-template-parsing'])
+
         # Run a compile test for the -fsized-deallocation flag. This is needed
         # in test/std/language.support/support.dynamic/new.delete
-        if self.cxx.hasCompileFlag('-fsized-deallocation'):
+        if has_sized_dealloc:
             self.config.available_features.add('fsized-deallocation')
 
-        if self.cxx.hasCompileFlag('-faligned-allocation'):
+        if has_aligned_alloc:
             self.config.available_features.add('-faligned-allocation')
         else:
             # FIXME remove this once more than just clang-4.0 support
             # C++17 aligned allocation.
             self.config.available_features.add('no-aligned-allocation')
 
-        if self.cxx.hasCompileFlag('-fdelayed-template-parsing'):
+        if has_delayed_parsing:
             self.config.available_features.add('fdelayed-template-parsing')
 
         if self.get_lit_bool('has_libatomic', False):
@@ -528,8 +1289,10 @@ class Configuration(object):
                 # Should we XFAIL them individually instead?
                 if maj_v <= 6:
                     possible_stds.remove('c++14')
-            for s in possible_stds:
-                if self.cxx.hasCompileFlag('-std=%s' % s):
+            supported_stds = self.cxx.hasCompileFlags(
+                ['-std=%s' % s for s in possible_stds])
+            for s, supported in zip(possible_stds, supported_stds):
+                if supported:
                     std = s
                     self.lit_config.note(
                         'inferred language dialect as: %s' % std)
@@ -613,6 +1376,7 @@ class Configuration(object):
             self.lit_config.fatal("cxx_headers='%s' is not a directory."
                                   % cxx_headers)
         self.cxx.compile_flags += ['-I' + cxx_headers]
+        self.cxx_headers = cxx_headers
         if self.libcxx_obj_root is not None:
             cxxabi_headers = os.path.join(self.libcxx_obj_root, 'include',
                                           'c++build')
@@ -707,6 +1471,14 @@ class Configuration(object):
           self.config.available_features.add('libcpp-abi-unstable')
           self.cxx.compile_flags += ['-D_LIBCPP_ABI_UNSTABLE']
 
+    def make_filesystem_dynamic_env(self):
+        dynamic_env = os.path.join(self.config.test_exec_root,
+                                   'filesystem', 'Output', 'dynamic_env')
+        dynamic_env = os.path.realpath(dynamic_env)
+        if not os.path.isdir(dynamic_env):
+            os.makedirs(dynamic_env)
+        return dynamic_env
+
     def configure_filesystem_compile_flags(self):
         enable_fs = self.get_lit_bool('enable_filesystem', default=False)
         if not enable_fs:
@@ -722,11 +1494,7 @@ class Configuration(object):
         assert os.path.isdir(static_env)
         self.cxx.compile_flags += ['-DLIBCXX_FILESYSTEM_STATIC_TEST_ROOT="%s"' % static_env]
 
-        dynamic_env = os.path.join(self.config.test_exec_root,
-                                   'filesystem', 'Output', 'dynamic_env')
-        dynamic_env = os.path.realpath(dynamic_env)
-        if not os.path.isdir(dynamic_env):
-            os.makedirs(dynamic_env)
+        dynamic_env = self.make_filesystem_dynamic_env()
         self.cxx.compile_flags += ['-DLIBCXX_FILESYSTEM_DYNAMIC_TEST_ROOT="%s"' % dynamic_env]
         self.exec_env['LIBCXX_FILESYSTEM_DYNAMIC_TEST_ROOT'] = ("%s" % dynamic_env)
 
@@ -900,30 +1668,33 @@ class Configuration(object):
             '-D_LIBCPP_HAS_NO_PRAGMA_SYSTEM_HEADER',
             '-Wall', '-Wextra', '-Werror'
         ]
-        if self.cxx.hasWarningFlag('-Wuser-defined-warnings'):
-            self.cxx.warning_flags += ['-Wuser-defined-warnings']
+        # All of the flags below are probed together.
+        self.cxx.addWarningFlagsIfSupported([
+            '-Wuser-defined-warnings',
+            '-Wshadow',
+            '-Wno-unused-command-line-argument',
+            '-Wno-attributes',
+            '-Wno-pessimizing-move',
+            '-Wno-c++11-extensions',
+            '-Wno-user-defined-literals',
+            '-Wno-noexcept-type',
+            '-Wno-aligned-allocation-unavailable',
+            # These warnings should be enabled in order to support the MSVC
+            # team using the test suite; They enable the warnings below and
+            # expect the test suite to be clean.
+            '-Wsign-compare',
+            '-Wunused-variable',
+            '-Wunused-parameter',
+            '-Wunreachable-code',
+            # FIXME: Enable the two warnings below.
+            '-Wno-conversion',
+            '-Wno-unused-local-typedef',
+            # FIXME: Remove this warning once the min/max handling patch lands
+            # See https://reviews.llvm.org/D33080
+            '-Wno-#warnings',
+        ])
+        if '-Wuser-defined-warnings' in self.cxx.warning_flags:
             self.config.available_features.add('diagnose-if-support')
-        self.cxx.addWarningFlagIfSupported('-Wshadow')
-        self.cxx.addWarningFlagIfSupported('-Wno-unused-command-line-argument')
-        self.cxx.addWarningFlagIfSupported('-Wno-attributes')
-        self.cxx.addWarningFlagIfSupported('-Wno-pessimizing-move')
-        self.cxx.addWarningFlagIfSupported('-Wno-c++11-extensions')
-        self.cxx.addWarningFlagIfSupported('-Wno-user-defined-literals')
-        self.cxx.addWarningFlagIfSupported('-Wno-noexcept-type')
-        self.cxx.addWarningFlagIfSupported('-Wno-aligned-allocation-unavailable')
-        # These warnings should be enabled in order to support the MSVC
-        # team using the test suite; They enable the warnings below and
-        # expect the test suite to be clean.
-        self.cxx.addWarningFlagIfSupported('-Wsign-compare')
-        self.cxx.addWarningFlagIfSupported('-Wunused-variable')
-        self.cxx.addWarningFlagIfSupported('-Wunused-parameter')
-        self.cxx.addWarningFlagIfSupported('-Wunreachable-code')
-        # FIXME: Enable the two warnings below.
-        self.cxx.addWarningFlagIfSupported('-Wno-conversion')
-        self.cxx.addWarningFlagIfSupported('-Wno-unused-local-typedef')
-        # FIXME: Remove this warning once the min/max handling patch lands
-        # See https://reviews.llvm.org/D33080
-        self.cxx.addWarningFlagIfSupported('-Wno-#warnings')
         std = self.get_lit_conf('std', None)
         if std in ['c++98', 'c++03']:
             # The '#define static_assert' provided by libc++ in C++03 mode
@@ -1021,18 +1792,166 @@ class Configuration(object):
         if not supports_modules:
             return
         self.config.available_features.add('modules-support')
-        module_cache = os.path.join(self.config.test_exec_root,
-                                   'modules.cache')
-        module_cache = os.path.realpath(module_cache)
-        if os.path.isdir(module_cache):
-            shutil.rmtree(module_cache)
-        os.makedirs(module_cache)
-        self.cxx.modules_flags = modules_flags + \
-            ['-fmodules-cache-path=' + module_cache]
+        self.cxx.modules_flags = modules_flags
+        self.configure_module_cache(enable_modules)
         if enable_modules:
             self.config.available_features.add('-fmodules')
             self.cxx.useModules()
 
+    def module_cache_key(self, modules_flags, cache_root):
+        # The modules are built from the headers by the compiler, using the
+        # module map and the modules flags. The digests of the headers are
+        # kept in "cache_root" and only computed again for the headers whose
+        # size or modification time changed.
+        parts = [modules_flags]
+        exe = libcxx.util.which(self.cxx.path)
+        if exe is not None:
+            exe = os.path.realpath(exe)
+            st = os.stat(exe)
+            parts += [exe, str(st.st_size), repr(st.st_mtime)]
+        if self.cxx_headers is not None:
+            stamps_path = os.path.join(cache_root, 'headers.json')
+            try:
+                with open(stamps_path, 'r') as f:
+                    previous = dict((path, (size, mtime, digest))
+                                    for path, size, mtime, digest
+                                    in json.load(f))
+            except (IOError, OSError, ValueError):
+                previous = {}
+            headers = []
+            for root, dirs, files in os.walk(self.cxx_headers):
+                dirs.sort()
+                headers += [os.path.join(root, f) for f in sorted(files)]
+            fingerprints = []
+            for path in headers:
+                st = os.stat(path)
+                stamp = previous.get(path)
+                if stamp is not None and \
+                        stamp[:2] == (st.st_size, st.st_mtime):
+                    digest = stamp[2]
+                else:
+                    digest = libcxx.util.hashFile(path)
+                fingerprints += [[path, st.st_size, st.st_mtime, digest]]
+                parts += [os.path.relpath(path, self.cxx_headers), digest]
+            libcxx.util.writeFileAtomic(stamps_path,
+                                        json.dumps(fingerprints))
+        return libcxx.util.hashData(*parts)
+
+    def configure_module_cache(self, enable_modules):
+        # When modules are enabled, keep the modules built by earlier runs in
+        # a directory named after everything they are built from, so that
+        # they are only rebuilt when one of those changes. Directories which
+        # have not been used for a week are removed. Otherwise only the tests
+        # which ask for modules use them, from a directory emptied on each
+        # run.
+        modules_flags = [f for f in self.cxx.modules_flags
+                         if not f.startswith('-fmodules-cache-path=')]
+        cache_root = os.path.join(self.config.test_exec_root,
+                                  'modules.cache')
+        cache_root = os.path.realpath(cache_root)
+        libcxx.util.mkdir_p(cache_root)
+        if not enable_modules:
+            module_cache = os.path.join(cache_root, 'tests')
+            shutil.rmtree(module_cache, ignore_errors=True)
+            libcxx.util.mkdir_p(module_cache)
+        else:
+            key = self.module_cache_key(modules_flags, cache_root)
+            module_cache = os.path.join(cache_root, key[:16])
+            libcxx.util.mkdir_p(module_cache)
+            os.utime(module_cache, None)
+            expiry = time.time() - 7 * 24 * 60 * 60
+            for name in os.listdir(cache_root):
+                path = os.path.join(cache_root, name)
+                try:
+                    if os.path.getmtime(path) < expiry:
+                        shutil.rmtree(path, ignore_errors=True)
+                except OSError:
+                    pass
+        self.module_cache = module_cache
+        self.cxx.modules_flags = modules_flags + \
+            ['-fmodules-cache-path=' + module_cache]
+
+    def configure_module_prebuild(self):
+        # Build the libc++ modules once, before the tests start, rather than
+        # letting the first tests which use them all build them at the same
+        # time.
+        if not self.get_lit_bool('prebuild_modules', False):
+            return
+        if not self.cxx.use_modules:
+            self.lit_config.warning('prebuild_modules has no effect unless '
+                                    'modules are enabled')
+            return
+        source = os.path.join(self.module_cache, 'prebuild.cpp')
+        libcxx.util.writeFileAtomic(source, '#include <cstddef>\n')
+        cxx = self.cxx.copy()
+        cxx.compile_cache = None
+        cmd, out, err, rc = cxx.compile(source, out=os.devnull)
+        if rc != 0:
+            self.lit_config.warning(
+                'Failed to prebuild the modules, the tests will build them '
+                'as they need them.\n' +
+                libcxx.util.makeReport(cmd, out, err, rc))
+            return
+        self.lit_config.note('prebuilt the modules in %s' % self.module_cache)
+
+    def configure_pch(self):
+        use_pch = self.get_lit_bool('use_pch', False)
+        if not use_pch:
+            return
+        if self.cxx.type not in ['clang', 'apple-clang']:
+            self.lit_config.warning('use_pch is only supported with Clang')
+            return
+        if self.cxx.use_modules:
+            self.lit_config.warning('use_pch cannot be combined with modules')
+            return
+        pch_dir = os.path.join(self.config.test_exec_root, 'pch')
+        header = os.path.join(pch_dir, 'libcxx_pch.h')
+        header_contents = '\n'.join(
+            ['// Generated by the libc++ test configuration. Do not edit.'] +
+            ['#include %s' % h for h in self.get_pch_headers()]) + '\n'
+        try:
+            with open(header, 'r') as f:
+                old_contents = f.read()
+        except IOError:
+            old_contents = None
+        if old_contents != header_contents:
+            libcxx.util.writeFileAtomic(header, header_contents)
+        # Name the PCH after the command used to build it, so that runs using
+        # different dialects or flags each get their own PCH.
+        pch_key = libcxx.util.hashData(self.cxx.compileCmd(header))
+        pch_path = os.path.join(pch_dir, 'libcxx_pch.%s.pch' % pch_key[:16])
+        inputs_path = pch_path + '.inputs'
+        try:
+            with open(inputs_path, 'r') as f:
+                up_to_date = fingerprintsMatch(json.load(f))
+        except (IOError, OSError, ValueError):
+            up_to_date = False
+        if not up_to_date:
+            dep_path = pch_path + '.d'
+            cmd, out, err, rc = self.cxx.precompileHeader(
+                header, pch_path, flags=['-MD', '-MF', dep_path])
+            deps = libcxx.util.parseDepFile(dep_path)
+            libcxx.util.cleanFile(dep_path)
+            if rc != 0:
+                report = libcxx.util.makeReport(cmd, out, err, rc)
+                self.lit_config.warning(
+                    'Failed to build the precompiled header, continuing '
+                    'without it.\n' + report)
+                return
+            fingerprints = fingerprintFiles((deps or []) + [pch_path])
+            if fingerprints is not None:
+                libcxx.util.writeFileAtomic(inputs_path,
+                                            json.dumps(fingerprints))
+        self.cxx.pch_flags = ['-include-pch', pch_path]
+        self.cxx.usePCH()
+
+    def get_pch_headers(self):
+        """Return the headers compiled into the precompiled header used by
+        the pass tests."""
+        return ['"test_macros.h"', '<cassert>', '<cstddef>', '<cstdlib>',
+                '<new>', '<limits>', '<type_traits>', '<utility>',
+                '<iterator>', '<memory>']
+
     def configure_substitutions(self):
         sub = self.config.substitutions
         cxx_path = pipes.quote(self.cxx.path)
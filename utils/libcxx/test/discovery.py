@@ -0,0 +1,90 @@
+#===----------------------------------------------------------------------===##
+#
+#                     The LLVM Compiler Infrastructure
+#
+# This file is dual licensed under the MIT and the University of Illinois Open
+# Source Licenses. See LICENSE.TXT for details.
+#
+#===----------------------------------------------------------------------===##
+
+"""
+A listing of the test directories shared by test discovery and by the tests.
+
+Each directory is scanned once and its listing is remembered until the
+modification time of the directory changes. When a directory is given, the
+listings are also written there, so the worker processes reuse the listings
+made during test discovery instead of scanning the directories again.
+"""
+
+import os
+
+from libcxx.cache import PersistentCache
+import libcxx.util
+
+
+def _scan(path):
+    # Return the names of the files of "path", ignoring directories and
+    # dot files.
+    files = []
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(path):
+            if entry.name.startswith('.'):
+                continue
+            if not entry.is_dir():
+                files += [entry.name]
+    else:
+        for name in os.listdir(path):
+            if name.startswith('.'):
+                continue
+            if not os.path.isdir(os.path.join(path, name)):
+                files += [name]
+    return sorted(files)
+
+
+class DiscoveryManifest(object):
+    """
+    The files and data files of each directory, keyed by path and validated
+    by the modification time of the directory. Entries are persisted under
+    "root" unless it is None.
+    """
+
+    def __init__(self, root=None):
+        self.cache = PersistentCache(root) if root is not None else None
+        self.entries = {}
+
+    def __getstate__(self):
+        # The format is pickled along with every test sent to a worker, so
+        # only the persisted listings are shared with the workers, which
+        # read those of the directories they need.
+        return {'cache': self.cache, 'entries': {}}
+
+    def get(self, path):
+        stamp = os.stat(path).st_mtime
+        entry = self.entries.get(path)
+        if entry is not None and entry['stamp'] == stamp:
+            return entry
+        key = libcxx.util.hashData(path)
+        if self.cache is not None:
+            entry = self.cache.get(key)
+        if entry is None or entry['stamp'] != stamp:
+            files = _scan(path)
+            entry = {
+                'stamp': stamp,
+                'files': files,
+                'data_files': [f for f in files if f.endswith('.dat')],
+            }
+            if self.cache is not None:
+                self.cache.put(key, entry)
+        self.entries[path] = entry
+        return entry
+
+    def test_files(self, path, suffixes, excludes=()):
+        """Return the names of the files of "path" ending with one of
+        "suffixes", except those in "excludes"."""
+        suffixes = tuple(suffixes)
+        return [f for f in self.get(path)['files']
+                if f.endswith(suffixes) and f not in excludes]
+
+    def data_files(self, path):
+        """Return the paths of the .dat files of the directory "path"."""
+        return [os.path.join(path, f) for f in self.get(path)['data_files']]
@@ -9,12 +9,21 @@
 
 import platform
 import os
+import tarfile
 
 from libcxx.test import tracing
-from libcxx.util import executeCommand
+from libcxx.util import executeCommand, guardedTempFilename, traceSpan
 
 
 class Executor(object):
+    def __repr__(self):
+        # Describe the configuration of the executor, including the executors
+        # it wraps, so that results can be cached per executor.
+        fields = ['%s=%r' % (k, v) for k, v in sorted(vars(self).items())
+                  if isinstance(v, (str, bool, int, float, list, tuple,
+                                    Executor))]
+        return '%s(%s)' % (type(self).__name__, ', '.join(fields))
+
     def run(self, exe_path, cmd, local_cwd, file_deps=None, env=None):
         """Execute a command.
             Be very careful not to change shared state in this function.
@@ -30,6 +39,18 @@ class Executor(object):
         """
         raise NotImplementedError
 
+    def run_bundle(self, bundle_dir, runner):
+        """Run a bundle of prebuilt tests.
+            The whole of 'bundle_dir' is made available on the target and
+            the shell script 'runner' inside it is executed from there.
+        Args:
+            bundle_dir: str: Local path to the bundle directory
+            runner: str:     Path of the runner script relative to bundle_dir
+        Returns:
+            cmd, out, err, exitCode
+        """
+        raise NotImplementedError
+
 
 class LocalExecutor(Executor):
     def __init__(self):
@@ -40,7 +61,14 @@ class LocalExecutor(Executor):
         cmd = cmd or [exe_path]
         if work_dir == '.':
             work_dir = os.getcwd()
-        out, err, rc = executeCommand(cmd, cwd=work_dir, env=env)
+        with traceSpan('run'):
+            out, err, rc = executeCommand(cmd, cwd=work_dir, env=env)
+        return (cmd, out, err, rc)
+
+    def run_bundle(self, bundle_dir, runner):
+        cmd = ['sh', runner]
+        with traceSpan('run-bundle'):
+            out, err, rc = executeCommand(cmd, cwd=bundle_dir)
         return (cmd, out, err, rc)
 
 
@@ -135,14 +163,37 @@ class RemoteExecutor(Executor):
                              for f in file_deps]
                 srcs.extend(file_deps)
                 dsts.extend(dev_paths)
-            self.copy_in(srcs, dsts)
+            with traceSpan('copy-in'):
+                self.copy_in(srcs, dsts)
             # TODO(jroelofs): capture the copy_in and delete_remote commands,
             # and conjugate them with '&&'s around the first tuple element
             # returned here:
-            return self._execute_command_remote(cmd, target_cwd, env)
+            with traceSpan('run'):
+                return self._execute_command_remote(cmd, target_cwd, env)
         finally:
             if target_cwd:
-                self.delete_remote(target_cwd)
+                with traceSpan('cleanup'):
+                    self.delete_remote(target_cwd)
+
+    def run_bundle(self, bundle_dir, runner):
+        # Ship the whole bundle as a single archive and run it with one
+        # remote command.
+        target_dir = None
+        try:
+            target_dir = self.remote_temp_dir()
+            target_archive = os.path.join(target_dir, 'bundle.tar.gz')
+            with guardedTempFilename(suffix='.tar.gz') as archive:
+                with tarfile.open(archive, 'w:gz') as tar:
+                    tar.add(bundle_dir, arcname='.')
+                with traceSpan('copy-in'):
+                    self.copy_in([archive], [target_archive])
+            cmd = ['tar', 'xzf', target_archive, '&&', 'sh', runner]
+            with traceSpan('run-bundle'):
+                return self._execute_command_remote(cmd, target_dir)
+        finally:
+            if target_dir:
+                with traceSpan('cleanup'):
+                    self.delete_remote(target_dir)
 
     def _execute_command_remote(self, cmd, remote_work_dir='.', env=None):
         raise NotImplementedError()
@@ -0,0 +1,110 @@
+#===----------------------------------------------------------------------===##
+#
+#                     The LLVM Compiler Infrastructure
+#
+# This file is dual licensed under the MIT and the University of Illinois Open
+# Source Licenses. See LICENSE.TXT for details.
+#
+#===----------------------------------------------------------------------===##
+
+"""
+Support for stopping a run early once too many tests have failed.
+
+The workers count finished and failed tests in files of a directory shared
+by the run, one byte per test, so that a count is the size of a file. The
+worker which reaches the limit creates a marker file. Every worker watches
+for that marker from a background thread and kills the commands it is
+running as soon as it appears.
+"""
+
+import os
+import threading
+import time
+
+import libcxx.util
+
+
+_watched = set()
+
+
+def _watch(marker):
+    while not os.path.exists(marker):
+        time.sleep(0.25)
+    libcxx.util.killActiveCommands()
+
+
+class FailureLimit(object):
+    """
+    Stop the run after "max_failures" unexpected failures, or once more than
+    "max_rate" of at least "min_tests" finished tests failed unexpectedly.
+    """
+
+    def __init__(self, directory, max_failures=None, max_rate=None,
+                 min_tests=20):
+        self.directory = directory
+        self.max_failures = max_failures
+        self.max_rate = max_rate
+        self.min_tests = min_tests
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _count(self, name):
+        try:
+            return os.path.getsize(self._path(name))
+        except OSError:
+            return 0
+
+    def _append(self, name):
+        fd = os.open(self._path(name), os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0o644)
+        try:
+            os.write(fd, b'.')
+        finally:
+            os.close(fd)
+
+    def failures(self):
+        return self._count('failures')
+
+    def reached(self):
+        return os.path.exists(self._path('stop'))
+
+    def watch(self):
+        """Kill the commands run by this process once the limit is reached
+        by any worker."""
+        marker = self._path('stop')
+        if marker in _watched:
+            return
+        _watched.add(marker)
+        watcher = threading.Thread(target=_watch, args=(marker,))
+        watcher.daemon = True
+        watcher.start()
+
+    def record(self, failed):
+        """Count a finished test, and stop the run if it reaches the
+        limit."""
+        libcxx.util.mkdir_p(self.directory)
+        self._append('finished')
+        if not failed:
+            return
+        self._append('failures')
+        failures = self.failures()
+        finished = self._count('finished')
+        if (self.max_failures is not None and
+                failures >= self.max_failures) or \
+           (self.max_rate is not None and finished >= self.min_tests and
+                failures > self.max_rate * finished):
+            with open(self._path('stop'), 'w'):
+                pass
+
+
+def is_unexpected_failure(test, code):
+    """Return True if lit will report the result "code" of "test" as a
+    failure once its XFAIL lines are taken into account."""
+    try:
+        expected_to_fail = test.isExpectedToFail()
+    except ValueError:
+        return True
+    if expected_to_fail:
+        return code.name == 'PASS'
+    return code.isFailure
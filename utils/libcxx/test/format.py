@@ -7,9 +7,13 @@
 #
 #===----------------------------------------------------------------------===##
 
+from contextlib import contextmanager
 import copy
 import errno
+import json
 import os
+import re
+import threading
 import time
 import random
 
@@ -18,10 +22,74 @@ import lit.TestRunner  # pylint: disable=import-error
 from lit.TestRunner import ParserKind, IntegratedTestKeywordParser  \
     # pylint: disable=import-error
 
+from libcxx.test.discovery import DiscoveryManifest
 from libcxx.test.executor import LocalExecutor as LocalExecutor
+from libcxx.test.failfast import is_unexpected_failure
+from libcxx.test.metadata import TestMetadataIndex, parse_test_script
+from libcxx.test.unity import make_unity_source
 import libcxx.util
 
 
+# The time the test running in each thread spent waiting for a phase slot, a
+# job token or memory, which is left out of its recorded time.
+_waitState = threading.local()
+
+
+def _variant_suffix(variant):
+    return re.sub(r'[^\w.+-]', '_', variant)
+
+
+def _history_name(path_in_suite, variant=None):
+    """Return the name the time and memory used by a test are recorded
+    under. Each configuration of a matrix run is recorded on its own."""
+    name = '/'.join(path_in_suite)
+    if variant is not None:
+        name += '.' + _variant_suffix(variant)
+    return name
+
+
+class LibcxxTest(lit.Test.Test):
+    """
+    A test which lit schedules ahead of the others when "early" is set. In a
+    matrix run, "variant" names the configuration the test is run in.
+    """
+
+    def __init__(self, suite, path_in_suite, config, early=False,
+                 variant=None):
+        lit.Test.Test.__init__(self, suite, path_in_suite, config)
+        self.early = early
+        self.variant = variant
+
+    def isEarlyTest(self):
+        return self.early or lit.Test.Test.isEarlyTest(self)
+
+    def getFullName(self):
+        name = lit.Test.Test.getFullName(self)
+        if self.variant is not None:
+            name += ' [%s]' % self.variant
+        return name
+
+    def getExecPath(self):
+        path = lit.Test.Test.getExecPath(self)
+        if self.variant is not None:
+            # Keep the build products of each configuration apart, in the
+            # same directory so that identical compiles can be shared.
+            path += '.' + _variant_suffix(self.variant)
+        return path
+
+
+class TestVariant(object):
+    """
+    One configuration of a matrix run: its name, the test format which runs
+    the tests in it and the features it provides.
+    """
+
+    def __init__(self, name, test_format, available_features):
+        self.name = name
+        self.test_format = test_format
+        self.available_features = set(available_features)
+
+
 class LibcxxTestFormat(object):
     """
     Custom test format handler for use with the test format use by libc++.
@@ -34,12 +102,44 @@ class LibcxxTestFormat(object):
     """
 
     def __init__(self, cxx, use_verify_for_fail, execute_external,
-                 executor, exec_env):
-        self.cxx = copy.deepcopy(cxx)
+                 executor, exec_env, result_cache=None, run_stats=None,
+                 unity_batch_size=0, phase_slots=None, bundle=None,
+                 bundle_phase=None, dep_index=None, changed_files=None,
+                 metadata_index=None, timings=None, memory_history=None,
+                 memory_budget=None, trace=False, failure_limit=None,
+                 variants=None, base_features=None, jobserver=None,
+                 manifest=None):
+        self.cxx = cxx.copy()
         self.use_verify_for_fail = use_verify_for_fail
         self.execute_external = execute_external
         self.executor = executor
         self.exec_env = dict(exec_env)
+        self.result_cache = result_cache
+        self.run_stats = run_stats
+        self.unity_batch_size = unity_batch_size
+        self.unity_batches = {}
+        self.phase_slots = dict(phase_slots or {})
+        self.bundle = bundle
+        self.bundle_phase = bundle_phase
+        self.dep_index = dep_index
+        self.changed_files = changed_files
+        if metadata_index is None:
+            metadata_index = TestMetadataIndex()
+        self.metadata_index = metadata_index
+        if manifest is None:
+            manifest = DiscoveryManifest()
+        self.manifest = manifest
+        self.timings = timings
+        self.memory_history = memory_history
+        self.memory_budget = memory_budget
+        self.trace = trace
+        self.failure_limit = failure_limit
+        self.variants = list(variants or [])
+        self.base_features = set(base_features or [])
+        self.jobserver = jobserver
+        # Identifies this lit invocation to the worker processes, which only
+        # reuse unity builds produced during the same run.
+        self.run_id = '%d.%f' % (os.getpid(), time.time())
 
     @staticmethod
     def _make_custom_parsers():
@@ -47,7 +147,9 @@ class LibcxxTestFormat(object):
             IntegratedTestKeywordParser('FLAKY_TEST.', ParserKind.TAG,
                                         initial_value=False),
             IntegratedTestKeywordParser('MODULES_DEFINES:', ParserKind.LIST,
-                                        initial_value=[])
+                                        initial_value=[]),
+            IntegratedTestKeywordParser('FILE-DEP:', ParserKind.LIST,
+                                        initial_value=None)
         ]
 
     @staticmethod
@@ -61,26 +163,132 @@ class LibcxxTestFormat(object):
     def getTestsInDirectory(self, testSuite, path_in_suite,
                             litConfig, localConfig):
         source_path = testSuite.getSourcePath(path_in_suite)
-        for filename in os.listdir(source_path):
-            # Ignore dot files and excluded tests.
-            if filename.startswith('.') or filename in localConfig.excludes:
-                continue
-
-            filepath = os.path.join(source_path, filename)
-            if not os.path.isdir(filepath):
-                if any([filename.endswith(ext)
-                        for ext in localConfig.suffixes]):
-                    yield lit.Test.Test(testSuite, path_in_suite + (filename,),
-                                        localConfig)
+        selected = skipped = 0
+        configs = [(None, localConfig)]
+        if self.variants:
+            # Run each test in every configuration of the matrix, keeping
+            # the features added by the lit.local.cfg files.
+            extra_features = localConfig.available_features - \
+                self.base_features
+            configs = []
+            for variant in self.variants:
+                variant_config = copy.copy(localConfig)
+                variant_config.available_features = \
+                    variant.available_features | extra_features
+                variant_config.test_format = variant.test_format
+                configs += [(variant.name, variant_config)]
+        for filename in self.manifest.test_files(source_path,
+                                                 localConfig.suffixes,
+                                                 localConfig.excludes):
+            if self.changed_files is not None:
+                # Only run the tests affected by the changed files.
+                filepath = os.path.join(source_path, filename)
+                if not self.dep_index.is_affected(filepath,
+                                                  self.changed_files):
+                    skipped += 1
+                    continue
+                selected += 1
+            test_path = path_in_suite + (filename,)
+            for variant, config in configs:
+                # Start the tests which were the slowest in previous runs
+                # first, so that they do not extend the end of the run.
+                early = self.timings is not None and \
+                    self.timings.is_slow(_history_name(test_path, variant))
+                yield LibcxxTest(testSuite, test_path, config, early=early,
+                                 variant=variant)
+        if selected or skipped:
+            self._record('selection', selected=selected, skipped=skipped)
+
+    def _record(self, kind, **fields):
+        if self.run_stats is not None:
+            self.run_stats.record(kind, **fields)
+
+    @contextmanager
+    def _phase(self, name):
+        # Wrap the 'compile' and 'execute' steps of a test, waiting for a
+        # free slot when the number of concurrent steps is limited.
+        slots = self.phase_slots.get(name)
+        if slots is None:
+            with self._job_token():
+                yield
+            return
+        with self._wait_for(slots.acquire()):
+            with self._job_token():
+                yield
+
+    @contextmanager
+    def _job_token(self):
+        # Count each step against the jobs of the make running lit, if it
+        # shares them through a jobserver.
+        if self.jobserver is None:
+            yield
+            return
+        with self._wait_for(self.jobserver.acquire()):
+            yield
+
+    @contextmanager
+    def _reserve_memory(self, name):
+        # Wait until the memory the test used in previous runs fits in the
+        # budget shared by all of the workers.
+        if self.memory_budget is None:
+            yield
+            return
+        amount = self.memory_history.estimate(name) or 0
+        with self._wait_for(self.memory_budget.acquire(int(amount))):
+            yield
+
+    @contextmanager
+    def _wait_for(self, resource):
+        # Enter "resource", counting the time spent waiting for it against
+        # the test running in this thread.
+        start = time.time()
+        with resource:
+            _waitState.seconds += time.time() - start
+            yield
+
+    @contextmanager
+    def _track_usage(self):
+        # The peak memory of the commands of a test is only needed to
+        # budget the memory of the next runs.
+        if self.memory_budget is None:
+            yield {'max_rss': None}
+            return
+        with libcxx.util.trackResourceUsage() as usage:
+            yield usage
+
+    def _skipped(self):
+        return (lit.Test.UNSUPPORTED,
+                'Skipped: the run was stopped after %d failures'
+                % self.failure_limit.failures())
 
     def execute(self, test, lit_config):
-        while True:
-            try:
-                return self._execute(test, lit_config)
-            except OSError as oe:
-                if oe.errno != errno.ETXTBSY:
-                    raise
-                time.sleep(0.1)
+        if self.failure_limit is not None:
+            if self.failure_limit.reached():
+                return self._skipped()
+            self.failure_limit.watch()
+        # lit makes a plain lit.Test.Test of a test named on its command line.
+        name = _history_name(test.path_in_suite,
+                            getattr(test, 'variant', None))
+        trace_sink = self.run_stats if self.trace else None
+        _waitState.seconds = 0.0
+        start = time.time()
+        with libcxx.util.tracedTask(trace_sink, name), \
+                self._reserve_memory(name), \
+                self._track_usage() as usage, \
+                libcxx.util.traceSpan('test'):
+            result = self._execute(test, lit_config)
+        elapsed = time.time() - start - _waitState.seconds
+        if self.failure_limit is not None:
+            code = result.code if isinstance(result, lit.Test.Result) \
+                else result[0]
+            failed = is_unexpected_failure(test, code)
+            if failed and self.failure_limit.reached():
+                # Most likely killed when another worker reached the limit.
+                return self._skipped()
+            self.failure_limit.record(failed)
+        self._record('test-usage', name=name, elapsed=elapsed,
+                     max_rss=usage['max_rss'])
+        return result
 
     def _execute(self, test, lit_config):
         name = test.path_in_suite[-1]
@@ -104,8 +312,11 @@ class LibcxxTestFormat(object):
             return (lit.Test.UNSUPPORTED, "Objective-C++ is not supported")
 
         parsers = self._make_custom_parsers()
-        script = lit.TestRunner.parseIntegratedTestScript(
-            test, additional_parsers=parsers, require_script=is_sh_test)
+        with libcxx.util.traceSpan('parse'):
+            metadata = self.metadata_index.get(test.getSourcePath())
+            script = parse_test_script(test, metadata,
+                                       additional_parsers=parsers,
+                                       require_script=is_sh_test)
         # Check if a result for the test was returned. If so return that
         # result.
         if isinstance(script, lit.Test.Result):
@@ -122,7 +333,8 @@ class LibcxxTestFormat(object):
                                                                tmpBase)
         script = lit.TestRunner.applySubstitutions(script, substitutions)
 
-        test_cxx = copy.deepcopy(self.cxx)
+        with libcxx.util.traceSpan('copy-compiler'):
+            test_cxx = self.cxx.copy()
         if is_fail_test:
             test_cxx.useCCache(False)
             test_cxx.useWarnings(False)
@@ -135,11 +347,15 @@ class LibcxxTestFormat(object):
             # FIXME: libc++ debug tests #define _LIBCPP_ASSERT to override it
             # If we see this we need to build the test against uniquely built
             # modules.
-            if is_libcxx_test:
-                with open(test.getSourcePath(), 'r') as f:
-                    contents = f.read()
-                if '#define _LIBCPP_ASSERT' in contents:
-                    test_cxx.useModules(False)
+            if is_libcxx_test and metadata['defines_libcpp_assert']:
+                test_cxx.useModules(False)
+
+        if test_cxx.use_pch:
+            # The precompiled header is only used for pass tests that do not
+            # configure libc++ or the test support headers through macros.
+            if not is_pass_test or is_objcxx_test or extra_modules_defines \
+                    or not metadata['can_use_pch']:
+                test_cxx.usePCH(False)
 
         if is_objcxx_test:
             test_cxx.source_lang = 'objective-c++'
@@ -149,6 +365,16 @@ class LibcxxTestFormat(object):
                 test_cxx.compile_flags += ['-fno-objc-arc']
             test_cxx.link_flags += ['-framework', 'Foundation']
 
+        if self.bundle_phase == 'run' and not is_pass_test:
+            # Everything but running the pass tests happened when the
+            # bundle was built.
+            return (lit.Test.UNSUPPORTED,
+                    'Only pass tests are run from a test bundle')
+
+        data_files = []
+        if is_pass_test:
+            data_files = self._get_data_files(test.getSourcePath(), parsers)
+
         # Dispatch the test based on its suffix.
         if is_sh_test:
             if not isinstance(self.executor, LocalExecutor):
@@ -160,30 +386,114 @@ class LibcxxTestFormat(object):
                                              self.execute_external, script,
                                              tmpBase)
         elif is_fail_test:
-            return self._evaluate_fail_test(test, test_cxx, parsers)
+            evaluate = lambda: self._evaluate_fail_test(test, test_cxx,
+                                                        parsers, metadata)
         elif is_pass_test:
-            return self._evaluate_pass_test(test, tmpBase, lit_config,
-                                            test_cxx, parsers)
+            evaluate = lambda: self._evaluate_pass_test(test, tmpBase,
+                                                        lit_config, test_cxx,
+                                                        parsers, data_files)
         else:
             # No other test type is supported
             assert False
 
+        is_flaky = self._get_parser('FLAKY_TEST.', parsers).getValue()
+        if self.result_cache is not None and self.bundle is None and \
+                not is_flaky:
+            return self._evaluate_cached(test, tmpBase, test_cxx,
+                                         is_pass_test, data_files, evaluate)
+        if self.dep_index is not None and self.bundle_phase != 'run':
+            result, _ = self._evaluate_with_deps(test, tmpBase, test_cxx,
+                                                 data_files, evaluate)
+            return result
+        return evaluate()
+
+    def _evaluate_with_deps(self, test, tmpBase, test_cxx, data_files,
+                            evaluate):
+        # Evaluate the test while asking the compiler for the headers it
+        # includes. Return the result and the files the test depends on,
+        # including its "data_files", or None if they are unknown.
+        source_path = test.getSourcePath()
+        dep_path = self._add_dependency_flags(test_cxx, tmpBase)
+        try:
+            result = evaluate()
+            deps = libcxx.util.parseDepFile(dep_path)
+        finally:
+            libcxx.util.cleanFile(dep_path)
+        if deps is not None:
+            deps += data_files
+            if self.dep_index is not None:
+                self.dep_index.record(source_path, deps)
+        return result, deps
+
+    @staticmethod
+    def _add_dependency_flags(test_cxx, tmpBase):
+        dep_path = tmpBase + '.d'
+        if '-MF' not in test_cxx.compile_flags:
+            libcxx.util.mkdir_p(os.path.dirname(tmpBase))
+            test_cxx.compile_flags += ['-MD', '-MF', dep_path]
+        return dep_path
+
+    def _evaluate_cached(self, test, tmpBase, test_cxx, is_pass_test,
+                         data_files, evaluate):
+        source_path = test.getSourcePath()
+        # Ask the compiler for the headers the test includes so that the
+        # cached result is invalidated when any of them change.
+        self._add_dependency_flags(test_cxx, tmpBase)
+        kind = 'pass' if is_pass_test else 'fail'
+        if not is_pass_test and self.use_verify_for_fail:
+            kind += '-verify'
+        key = self.result_cache.key(source_path, kind,
+                                    test_cxx.compileLinkCmd(source_path),
+                                    self.exec_env, self.executor)
+        result = self.result_cache.lookup(key)
+        self._record('result-cache', hit=result is not None)
+        if result is not None:
+            return result
+        result, deps = self._evaluate_with_deps(test, tmpBase, test_cxx,
+                                                data_files, evaluate)
+        # Once the failure limit is reached, the commands of the test may
+        # have been killed, so its result is not the test's own.
+        if self.failure_limit is not None and self.failure_limit.reached():
+            return result
+        if deps is not None:
+            self.result_cache.store(key, deps, result)
+        return result
+
     def _clean(self, exec_path):  # pylint: disable=no-self-use
         libcxx.util.cleanFile(exec_path)
 
+    def _get_data_files(self, source_path, parsers):
+        # The files a test reads are listed, relative to the directory of
+        # the test, with `// FILE-DEP: foo.dat, bar.dat`. An empty
+        # `// FILE-DEP:` declares that the test reads no files. Tests without
+        # the keyword depend on all of the .dat files of their directory.
+        local_cwd = os.path.dirname(source_path)
+        file_deps = self._get_parser('FILE-DEP:', parsers).getValue()
+        if file_deps is None:
+            return self.manifest.data_files(local_cwd)
+        return [os.path.join(local_cwd, f) for f in file_deps if f]
+
     def _evaluate_pass_test(self, test, tmpBase, lit_config,
-                            test_cxx, parsers):
+                            test_cxx, parsers, data_files):
         execDir = os.path.dirname(test.getExecPath())
         source_path = test.getSourcePath()
         exec_path = tmpBase + '.exe'
         object_path = tmpBase + '.o'
+        if self.bundle_phase == 'run':
+            return self._evaluate_bundled_test(test)
         # Create the output directory if it does not already exist.
         libcxx.util.mkdir_p(os.path.dirname(tmpBase))
+        if self.unity_batch_size and not test_cxx.use_modules:
+            result = self._evaluate_unity_test(test, tmpBase, test_cxx,
+                                               data_files)
+            if result is not None:
+                return result
         try:
             # Compile the test
-            cmd, out, err, rc = test_cxx.compileLinkTwoSteps(
-                source_path, out=exec_path, object_file=object_path,
-                cwd=execDir)
+            with self._phase('compile'):
+                cmd, out, err, rc = test_cxx.compileLinkTwoSteps(
+                    source_path, out=exec_path, object_file=object_path,
+                    cwd=execDir)
             compile_cmd = cmd
             if rc != 0:
                 report = libcxx.util.makeReport(cmd, out, err, rc)
@@ -194,18 +504,18 @@ class LibcxxTestFormat(object):
             env = None
             if self.exec_env:
                 env = self.exec_env
-            # TODO: Only list actually needed files in file_deps.
-            # Right now we just mark all of the .dat files in the same
-            # directory as dependencies, but it's likely less than that. We
-            # should add a `// FILE-DEP: foo.dat` to each test to track this.
-            data_files = [os.path.join(local_cwd, f)
-                          for f in os.listdir(local_cwd) if f.endswith('.dat')]
             is_flaky = self._get_parser('FLAKY_TEST.', parsers).getValue()
             max_retry = 3 if is_flaky else 1
+            if self.bundle_phase == 'build':
+                self.bundle.add(test, exec_path, data_files, max_retry)
+                # Not a pass, which lit would turn into an XPASS for the
+                # tests expected to fail at run time.
+                return (lit.Test.UNSUPPORTED,
+                        'Built into the test bundle\n')
             for retry_count in range(max_retry):
-                cmd, out, err, rc = self.executor.run(exec_path, [exec_path],
-                                                      local_cwd, data_files,
-                                                      env)
+                with self._phase('execute'):
+                    cmd, out, err, rc = self._run_executable(
+                        exec_path, [exec_path], local_cwd, data_files, env)
                 if rc == 0:
                     res = lit.Test.PASS if retry_count == 0 else lit.Test.FLAKYPASS
                     return res, ''
@@ -219,18 +529,158 @@ class LibcxxTestFormat(object):
         finally:
             # Note that cleanup of exec_file happens in `_clean()`. If you
             # override this, cleanup is your reponsibility.
-            libcxx.util.cleanFile(object_path)
-            self._clean(exec_path)
+            with libcxx.util.traceSpan('cleanup'):
+                libcxx.util.cleanFile(object_path)
+                self._clean(exec_path)
+
+    # The delays between the attempts to run an executable which is busy.
+    _etxtbsy_delays = [0.05, 0.1, 0.2, 0.4, 0.8, 1.6, 3.2]
+
+    def _run_executable(self, exec_path, cmd, local_cwd, data_files, env):
+        # Another worker may have forked while this test was being linked,
+        # leaving the executable open for writing in its child until that
+        # child calls exec. Running the executable fails with ETXTBSY until
+        # then, so wait and try again rather than rebuilding the test.
+        for delay in self._etxtbsy_delays + [None]:
+            try:
+                return self.executor.run(exec_path, cmd, local_cwd,
+                                         data_files, env)
+            except OSError as oe:
+                if oe.errno != errno.ETXTBSY or delay is None:
+                    raise
+            self._record('etxtbsy-retry')
+            time.sleep(delay)
+
+    def _evaluate_bundled_test(self, test):
+        result = self.bundle.result(test)
+        if result is None:
+            return (lit.Test.UNRESOLVED,
+                    'No result for this test in the test bundle at %s\n'
+                    % self.bundle.root)
+        if result['rc'] == 0:
+            res = lit.Test.PASS if result['attempts'] == 1 \
+                else lit.Test.FLAKYPASS
+            return res, ''
+        report = libcxx.util.makeReport(
+            'tests/%s/test.exe' % self.bundle.test_id(test), result['out'],
+            result['err'], result['rc'])
+        report += "Compiled test failed unexpectedly!"
+        return lit.Test.FAIL, report
+
+    def _get_unity_batch(self, test):
+        # Split the compatible tests of the directory into fixed size batches.
+        # Every worker computes the same batches from the directory contents.
+        source_path = test.getSourcePath()
+        source_dir = os.path.dirname(source_path)
+        batches = self.unity_batches.get(source_dir)
+        if batches is None:
+            compatible = []
+            for name in self.manifest.test_files(source_dir, ['.pass.cpp'],
+                                                 test.config.excludes):
+                path = os.path.join(source_dir, name)
+                if self.metadata_index.get(path)['can_unity_build']:
+                    with open(path, 'r') as f:
+                        compatible += [(name, path, f.read())]
+            batches = {}
+            for i in range(0, len(compatible), self.unity_batch_size):
+                batch = compatible[i:i + self.unity_batch_size]
+                # A single test gains nothing from batching.
+                if len(batch) > 1:
+                    for _, path, _ in batch:
+                        batches[path] = batch
+            self.unity_batches[source_dir] = batches
+        return batches.get(source_path)
+
+    @staticmethod
+    def _unity_compiler(test_cxx):
+        # Build the batch with the compiler of the test, but without the
+        # dependency file of the test.
+        batch_cxx = test_cxx.copy()
+        flags = batch_cxx.compile_flags
+        if '-MF' in flags:
+            i = flags.index('-MF')
+            batch_cxx.compile_flags = [f for j, f in enumerate(flags)
+                                       if j not in (i, i + 1) and f != '-MD']
+        return batch_cxx
+
+    def _build_unity_batch(self, test, tmpBase, test_cxx, batch):
+        # The first worker to reach a batch builds it; the others wait on the
+        # lock and reuse the outcome recorded in the status file. Tests of
+        # the batch compiled with different flags each get a build of their
+        # own.
+        source_dir = os.path.dirname(test.getSourcePath())
+        batch_cxx = self._unity_compiler(test_cxx)
+        batch_id = libcxx.util.hashData(
+            [path for _, path, _ in batch],
+            batch_cxx.compileLinkCmd('unity.cpp', out='unity.exe'))
+        batch_base = os.path.join(os.path.dirname(tmpBase),
+                                  'unity.%s' % batch_id[:16])
+        status_path = batch_base + '.status'
+        with libcxx.util.lockedFile(batch_base + '.lock'):
+            try:
+                with open(status_path, 'r') as f:
+                    status = json.load(f)
+                if status['run'] == self.run_id:
+                    return status
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+            source = batch_base + '.cpp'
+            dep_path = batch_base + '.d'
+            with open(source, 'w') as f:
+                f.write(make_unity_source(batch))
+            batch_cxx.compile_flags += ['-I' + source_dir, '-MD', '-MF',
+                                        dep_path]
+            with self._phase('compile'):
+                cmd, out, err, rc = batch_cxx.compileLinkTwoSteps(
+                    source, out=batch_base + '.exe',
+                    object_file=batch_base + '.o',
+                    cwd=os.path.dirname(test.getExecPath()))
+            libcxx.util.cleanFile(batch_base + '.o')
+            status = {'run': self.run_id, 'ok': rc == 0,
+                      'exe': batch_base + '.exe', 'cmd': cmd,
+                      'deps': libcxx.util.parseDepFile(dep_path) or []}
+            libcxx.util.cleanFile(dep_path)
+            libcxx.util.writeFileAtomic(status_path, json.dumps(status))
+            self._record('unity-build', ok=status['ok'], size=len(batch))
+            return status
+
+    def _evaluate_unity_test(self, test, tmpBase, test_cxx, data_files):
+        batch = self._get_unity_batch(test)
+        if batch is None:
+            return None
+        status = self._build_unity_batch(test, tmpBase, test_cxx, batch)
+        if not status['ok']:
+            # Some test in the batch does not compile in this form (or at
+            # all); fall back to building every test on its own.
+            return None
+        if '-MF' in test_cxx.compile_flags:
+            # Report the dependencies of the whole batch for this test.
+            dep_path = test_cxx.compile_flags[
+                test_cxx.compile_flags.index('-MF') + 1]
+            libcxx.util.writeFileAtomic(dep_path, 'unity: %s\n' % ' '.join(
+                [d.replace(' ', '\\ ') for d in status['deps']]))
+        source_path = test.getSourcePath()
+        exec_path = status['exe']
+        local_cwd = os.path.dirname(source_path)
+        env = None
+        if self.exec_env:
+            env = self.exec_env
+        with self._phase('execute'):
+            cmd, out, err, rc = self._run_executable(
+                exec_path, [exec_path, os.path.basename(source_path)],
+                local_cwd, data_files, env)
+        if rc == 0:
+            return lit.Test.PASS, ''
+        report = libcxx.util.makeReport(cmd, out, err, rc)
+        report = "Compiled With: %s\n%s" % (status['cmd'], report)
+        report += "Compiled test failed unexpectedly!"
+        return lit.Test.FAIL, report
 
-    def _evaluate_fail_test(self, test, test_cxx, parsers):
+    def _evaluate_fail_test(self, test, test_cxx, parsers, metadata):
         source_path = test.getSourcePath()
         # FIXME: lift this detection into LLVM/LIT.
-        with open(source_path, 'r') as f:
-            contents = f.read()
-        verify_tags = ['expected-note', 'expected-remark', 'expected-warning',
-                       'expected-error', 'expected-no-diagnostics']
         use_verify = self.use_verify_for_fail and \
-                     any([tag in contents for tag in verify_tags])
+                     metadata['has_verify_tags']
         # FIXME(EricWF): GCC 5 does not evaluate static assertions that
         # are dependant on a template parameter when '-fsyntax-only' is passed.
         # This is fixed in GCC 6. However for now we only pass "-fsyntax-only"
@@ -243,7 +693,8 @@ class LibcxxTestFormat(object):
             if '-Wuser-defined-warnings' in test_cxx.warning_flags:
                 test_cxx.warning_flags += ['-Wno-error=user-defined-warnings']
 
-        cmd, out, err, rc = test_cxx.compile(source_path, out=os.devnull)
+        with self._phase('compile'):
+            cmd, out, err, rc = test_cxx.compile(source_path, out=os.devnull)
         expected_rc = 0 if use_verify else 1
         if rc == expected_rc:
             return lit.Test.PASS, ''
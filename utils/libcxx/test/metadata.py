@@ -0,0 +1,191 @@
+#===----------------------------------------------------------------------===##
+#
+#                     The LLVM Compiler Infrastructure
+#
+# This file is dual licensed under the MIT and the University of Illinois Open
+# Source Licenses. See LICENSE.TXT for details.
+#
+#===----------------------------------------------------------------------===##
+
+"""
+An index of the facts the test format needs from each test source.
+
+Each source is read once to extract its lit keywords and the few properties
+the test format looks for in its contents. The result is remembered for as
+long as the file's size and modification time are unchanged, both in the
+process and, when a directory is given, across runs.
+"""
+
+import os
+import re
+
+import lit.Test        # pylint: disable=import-error
+from lit.TestRunner import ParserKind, IntegratedTestKeywordParser  \
+    # pylint: disable=import-error
+
+from libcxx.cache import PersistentCache
+from libcxx.test.unity import can_unity_build
+import libcxx.util
+
+
+# Every keyword used by lit or by the custom parsers of the test format.
+_keywords = ['RUN:', 'XFAIL:', 'REQUIRES:', 'REQUIRES-ANY:', 'UNSUPPORTED:',
+             'END.', 'FLAKY_TEST.', 'MODULES_DEFINES:', 'FILE-DEP:']
+
+_keywords_re = re.compile(libcxx.util.to_bytes(
+    '(%s)(.*)\n' % '|'.join(re.escape(k) for k in _keywords)))
+
+_verify_tags = ['expected-note', 'expected-remark', 'expected-warning',
+                'expected-error', 'expected-no-diagnostics']
+
+# Bump this whenever the facts extracted from the sources change.
+_index_version = '2'
+
+
+def _scan_commands(data):
+    # Return the keyword lines of "data" as (line_number, keyword, line)
+    # lists, exactly as lit.TestRunner.parseIntegratedTestScriptCommands.
+    if not data.endswith(b'\n'):
+        data += b'\n'
+    commands = []
+    line_number = 1
+    last_match_position = 0
+    for match in _keywords_re.finditer(data):
+        match_position = match.start()
+        line_number += data.count(b'\n', last_match_position, match_position)
+        last_match_position = match_position
+        keyword, ln = match.groups()
+        commands += [[line_number,
+                      libcxx.util.to_string(keyword.decode('utf-8')),
+                      libcxx.util.to_string(
+                          ln.decode('utf-8').rstrip('\r'))]]
+    return commands
+
+
+def _can_use_pch(contents):
+    # The precompiled header is processed before any line of the test,
+    # so macros defined ahead of the first #include, or macros that
+    # configure libc++ itself, would not be seen by the headers it
+    # contains.
+    first_include = contents.find('#include')
+    for m in re.finditer(r'^\s*#\s*(define|undef)\s+(\w+)', contents,
+                         re.MULTILINE):
+        directive, macro = m.groups()
+        if directive == 'undef' or m.start() < first_include:
+            return False
+        if macro.startswith('_LIBCPP') or macro.startswith('_LIBCXX'):
+            return False
+    return True
+
+
+def extract_metadata(source_path):
+    """Read the test "source_path" and return the facts about it used by
+    the test format."""
+    with open(source_path, 'rb') as f:
+        data = f.read()
+    contents = libcxx.util.convert_string(data)
+    return {
+        'commands': _scan_commands(data),
+        'has_verify_tags': any(tag in contents for tag in _verify_tags),
+        'defines_libcpp_assert': '#define _LIBCPP_ASSERT' in contents,
+        'can_use_pch': _can_use_pch(contents),
+        'can_unity_build': can_unity_build(contents),
+    }
+
+
+class TestMetadataIndex(object):
+    """
+    The metadata of test sources, keyed by path and validated by size and
+    modification time. Entries are persisted under "root" unless it is None.
+    """
+
+    def __init__(self, root=None):
+        self.cache = PersistentCache(root) if root is not None else None
+        self.entries = {}
+
+    def get(self, source_path):
+        st = os.stat(source_path)
+        stamp = [st.st_size, st.st_mtime]
+        entry = self.entries.get(source_path)
+        if entry is not None and entry['stamp'] == stamp:
+            return entry
+        key = libcxx.util.hashData(_index_version, source_path)
+        if self.cache is not None:
+            entry = self.cache.get(key)
+        if entry is None or entry['stamp'] != stamp:
+            entry = extract_metadata(source_path)
+            entry['stamp'] = stamp
+            if self.cache is not None:
+                self.cache.put(key, entry)
+        self.entries[source_path] = entry
+        return entry
+
+
+def parse_test_script(test, metadata, additional_parsers=[],
+                      require_script=True):
+    """Do what lit.TestRunner.parseIntegratedTestScript does, using the
+    keyword lines recorded in "metadata" instead of reading the test."""
+    script = []
+    builtin_parsers = [
+        IntegratedTestKeywordParser('RUN:', ParserKind.COMMAND,
+                                    initial_value=script),
+        IntegratedTestKeywordParser('XFAIL:', ParserKind.BOOLEAN_EXPR,
+                                    initial_value=test.xfails),
+        IntegratedTestKeywordParser('REQUIRES:', ParserKind.BOOLEAN_EXPR,
+                                    initial_value=test.requires),
+        IntegratedTestKeywordParser('UNSUPPORTED:', ParserKind.BOOLEAN_EXPR,
+                                    initial_value=test.unsupported),
+        IntegratedTestKeywordParser('END.', ParserKind.TAG)
+    ]
+    if hasattr(IntegratedTestKeywordParser, '_handleRequiresAny'):
+        builtin_parsers += [IntegratedTestKeywordParser(
+            'REQUIRES-ANY:', ParserKind.CUSTOM,
+            IntegratedTestKeywordParser._handleRequiresAny,
+            initial_value=test.requires)]
+    keyword_parsers = dict((p.keyword, p) for p in builtin_parsers)
+    for parser in additional_parsers:
+        keyword_parsers[parser.keyword] = parser
+
+    for line_number, command_type, ln in metadata['commands']:
+        parser = keyword_parsers.get(command_type)
+        if parser is None:
+            continue
+        parser.parseLine(line_number, ln)
+        if command_type == 'END.' and parser.getValue() is True:
+            break
+
+    # Verify the script contains a run line.
+    if require_script and not script:
+        return lit.Test.Result(lit.Test.UNRESOLVED, "Test has no run line!")
+
+    # Check for unterminated run lines.
+    if script and script[-1][-1] == '\\':
+        return lit.Test.Result(lit.Test.UNRESOLVED,
+                               "Test has unterminated run lines (with '\\')")
+
+    # Enforce REQUIRES:
+    missing_required_features = test.getMissingRequiredFeatures()
+    if missing_required_features:
+        msg = ', '.join(missing_required_features)
+        return lit.Test.Result(lit.Test.UNSUPPORTED,
+                               "Test requires the following unavailable "
+                               "features: %s" % msg)
+
+    # Enforce UNSUPPORTED:
+    unsupported_features = test.getUnsupportedFeatures()
+    if unsupported_features:
+        msg = ', '.join(unsupported_features)
+        return lit.Test.Result(
+            lit.Test.UNSUPPORTED,
+            "Test does not support the following features "
+            "and/or targets: %s" % msg)
+
+    # Enforce limit_to_features.
+    if hasattr(test, 'isWithinFeatureLimits') and \
+            not test.isWithinFeatureLimits():
+        msg = ', '.join(test.config.limit_to_features)
+        return lit.Test.Result(lit.Test.UNSUPPORTED,
+                               "Test does not require any of the features "
+                               "specified in limit_to_features: %s" % msg)
+
+    return script
@@ -0,0 +1,62 @@
+#===----------------------------------------------------------------------===##
+#
+#                     The LLVM Compiler Infrastructure
+#
+# This file is dual licensed under the MIT and the University of Illinois Open
+# Source Licenses. See LICENSE.TXT for details.
+#
+#===----------------------------------------------------------------------===##
+
+import os
+
+import lit.Test  # pylint: disable=import-error
+
+from libcxx.cache import PersistentCache, fingerprintFiles, fingerprintsMatch
+import libcxx.util
+
+
+class TestResultCache(object):
+    """
+    Remember the outcome of .pass.cpp and .fail.cpp tests across lit runs.
+
+    Results are keyed by the test, the compiler command line, the executor
+    and the variables the configuration sets in the execution environment.
+    Each entry also records a fingerprint of every file the result depends
+    on: the headers reported by the compiler, the data files used at runtime
+    and the libc++ binaries being tested. An entry is only reused while all
+    of those files are unchanged.
+    """
+
+    def __init__(self, root, library_files):
+        self.cache = PersistentCache(root)
+        self.library_files = list(library_files)
+
+    # lit points these at a fresh temporary directory on every run.
+    _volatile_env_vars = ['TMP', 'TEMP', 'TMPDIR', 'TEMPDIR']
+
+    def key(self, source_path, kind, cmd, env, executor):
+        # Only the variables the configuration adds or changes; the rest of
+        # the environment lit was started with, such as MAKEFLAGS or the ids
+        # of a CI job, changes from one invocation to the next.
+        env_list = ['%s=%s' % (k, v) for k, v in sorted((env or {}).items())
+                    if k not in self._volatile_env_vars and
+                    os.environ.get(k) != v]
+        return libcxx.util.hashData(source_path, kind, cmd, env_list,
+                                    repr(executor))
+
+    def lookup(self, key):
+        entry = self.cache.get(key)
+        if entry is None or not fingerprintsMatch(entry['inputs']):
+            return None
+        return getattr(lit.Test, entry['code']), entry['output']
+
+    def store(self, key, inputs, result):
+        code, output = result
+        # Only deterministic outcomes are cached.
+        if code not in (lit.Test.PASS, lit.Test.FAIL):
+            return
+        fingerprints = fingerprintFiles(list(inputs) + self.library_files)
+        if fingerprints is None:
+            return
+        self.cache.put(key, {'code': code.name, 'output': output,
+                             'inputs': fingerprints})
@@ -0,0 +1,72 @@
+#===----------------------------------------------------------------------===##
+#
+#                     The LLVM Compiler Infrastructure
+#
+# This file is dual licensed under the MIT and the University of Illinois Open
+# Source Licenses. See LICENSE.TXT for details.
+#
+#===----------------------------------------------------------------------===##
+
+"""
+Support for only running the tests affected by a set of changed files.
+"""
+
+import os
+
+from libcxx.cache import PersistentCache
+import libcxx.util
+
+
+def normalize_path(path):
+    return os.path.normcase(os.path.realpath(path))
+
+
+class DependencyIndex(object):
+    """
+    The files each test depended on the last time it was compiled, as
+    reported by the compiler, plus the data files of .pass.cpp tests.
+    """
+
+    def __init__(self, root):
+        self.cache = PersistentCache(root)
+
+    def _key(self, source_path):  # pylint: disable=no-self-use
+        return libcxx.util.hashData(normalize_path(source_path))
+
+    def record(self, source_path, deps):
+        deps = sorted(set(normalize_path(d) for d in deps))
+        # Most tests are compiled with the same dependencies on every run;
+        # avoid rewriting those entries.
+        entry = self.cache.get(self._key(source_path))
+        if entry is not None and entry.get('deps') == deps:
+            return
+        self.cache.put(self._key(source_path), {'deps': deps})
+
+    def get(self, source_path):
+        """Return the recorded dependencies of the test "source_path", or
+        None if it was never compiled."""
+        entry = self.cache.get(self._key(source_path))
+        if entry is None:
+            return None
+        return entry.get('deps')
+
+    def is_affected(self, source_path, changed):
+        """Return True if the test "source_path" may be affected by the
+        normalized paths in "changed"."""
+        if normalize_path(source_path) in changed:
+            return True
+        deps = self.get(source_path)
+        return deps is None or any(d in changed for d in deps)
+
+
+def git_changed_files(src_root, since):
+    """Return the files of the git checkout containing "src_root" which
+    differ from the revision "since", including uncommitted and untracked
+    files."""
+    top = libcxx.util.capture(['git', '-C', src_root, 'rev-parse',
+                               '--show-toplevel']).strip()
+    changed = libcxx.util.capture(['git', '-C', top, 'diff', '--name-only',
+                                   since, '--']).splitlines()
+    changed += libcxx.util.capture(['git', '-C', top, 'ls-files', '--others',
+                                    '--exclude-standard']).splitlines()
+    return [os.path.join(top, f) for f in changed if f.strip()]
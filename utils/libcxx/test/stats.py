@@ -0,0 +1,63 @@
+#===----------------------------------------------------------------------===##
+#
+#                     The LLVM Compiler Infrastructure
+#
+# This file is dual licensed under the MIT and the University of Illinois Open
+# Source Licenses. See LICENSE.TXT for details.
+#
+#===----------------------------------------------------------------------===##
+
+import json
+import os
+
+import libcxx.util
+
+
+class RunStatistics(object):
+    """
+    Collect events reported by the lit worker processes of a single run so
+    that the main process can summarize them once every test has finished.
+
+    Each event is appended to a shared file as a single line of JSON. Small
+    appends are atomic, so no further locking is needed between workers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def record(self, kind, **fields):
+        fields['kind'] = kind
+        line = libcxx.util.to_bytes(json.dumps(fields) + '\n')
+        try:
+            libcxx.util.mkdir_p(os.path.dirname(self.path))
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+    def events(self, kind=None):
+        try:
+            with open(self.path, 'r') as f:
+                lines = f.readlines()
+        except (IOError, OSError):
+            return []
+        events = []
+        for l in lines:
+            try:
+                event = json.loads(l)
+            except ValueError:
+                continue
+            if kind is None or event.get('kind') == kind:
+                events += [event]
+        return events
+
+    def count(self, kind, **match):
+        return len([e for e in self.events(kind)
+                    if all(e.get(k) == v for k, v in match.items())])
+
+    def clear(self):
+        libcxx.util.cleanFile(self.path)
@@ -0,0 +1,102 @@
+#===----------------------------------------------------------------------===##
+#
+#                     The LLVM Compiler Infrastructure
+#
+# This file is dual licensed under the MIT and the University of Illinois Open
+# Source Licenses. See LICENSE.TXT for details.
+#
+#===----------------------------------------------------------------------===##
+
+"""
+A small scheduler for the steps of the test suite configuration.
+
+Each step names the steps it depends on. A step is started as soon as all of
+them are done, so that steps which only wait on the compiler, such as the
+probes of the features it supports, run concurrently.
+"""
+
+import multiprocessing
+import sys
+import threading
+import time
+
+
+# How many steps may run at the same time by default.
+default_jobs = min(multiprocessing.cpu_count(), 8)
+
+
+class StepGraph(object):
+    """
+    The steps to run, in the order they were added, and the steps each
+    depends on. A step may only depend on steps added before it.
+    """
+
+    def __init__(self, jobs=1):
+        self.jobs = jobs
+        self.steps = []
+        self.timings = []
+        self._lock = threading.Lock()
+
+    def add(self, name, function, after=None):
+        """Add the step "name" running "function". "after" lists the steps
+        it depends on; by default it runs after the step added before it."""
+        if after is None:
+            after = [self.steps[-1][0]] if self.steps else []
+        names = [n for n, _, _ in self.steps]
+        for dep in after:
+            if dep not in names:
+                raise ValueError('step %r depends on unknown step %r'
+                                 % (name, dep))
+        self.steps += [(name, function, list(after))]
+
+    def _run_step(self, name, function):
+        start = time.time()
+        function()
+        with self._lock:
+            self.timings.append((name, time.time() - start))
+
+    def run(self):
+        """Run every step, and return the time taken by each as a list of
+        (name, seconds) in the order the steps finished. If a step fails, no
+        other step is started and its exception is raised once the running
+        steps are done."""
+        if self.jobs <= 1:
+            for name, function, _ in self.steps:
+                self._run_step(name, function)
+            return self.timings
+
+        cond = threading.Condition()
+        started = set()
+        done = set()
+        errors = []
+
+        def worker(name, function):
+            try:
+                self._run_step(name, function)
+            except BaseException:
+                with cond:
+                    errors.append(sys.exc_info())
+            finally:
+                with cond:
+                    done.add(name)
+                    cond.notify()
+
+        with cond:
+            while len(done) < len(self.steps):
+                for name, function, after in self.steps:
+                    if errors or len(started) - len(done) >= self.jobs:
+                        break
+                    if name in started or \
+                            not all(dep in done for dep in after):
+                        continue
+                    started.add(name)
+                    thread = threading.Thread(target=worker,
+                                              args=(name, function))
+                    thread.daemon = True
+                    thread.start()
+                if errors and len(done) == len(started):
+                    break
+                cond.wait()
+        if errors:
+            raise errors[0][1]
+        return self.timings
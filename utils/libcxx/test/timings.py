@@ -0,0 +1,108 @@
+#===----------------------------------------------------------------------===##
+#
+#                     The LLVM Compiler Infrastructure
+#
+# This file is dual licensed under the MIT and the University of Illinois Open
+# Source Licenses. See LICENSE.TXT for details.
+#
+#===----------------------------------------------------------------------===##
+
+"""
+What each test cost during previous runs, used to schedule the tests of the
+next run: the wall-clock time, to start the slowest tests first, and the
+peak memory, to keep concurrent tests within a memory budget.
+"""
+
+import json
+import posixpath
+
+import libcxx.util
+
+
+class TestHistory(object):
+    """
+    A value recorded for each test, keyed by its path in the test suite and,
+    in a matrix run, by the configuration it ran in.
+
+    Tests without a recorded value are estimated from the mean value of the
+    tests of their directory, or of the closest parent directory with
+    recorded tests. The file is read on first use by each process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.values = None
+
+    def __getstate__(self):
+        # Do not send the history along with every test given to a worker;
+        # the workers which need it read it themselves.
+        return {'path': self.path, 'values': None}
+
+    def _load(self):
+        if self.values is not None:
+            return
+        try:
+            with open(self.path, 'r') as f:
+                self.values = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.values = {}
+        self._init_estimates()
+
+    def _init_estimates(self):
+        totals = {}
+        for name, value in self.values.items():
+            d = posixpath.dirname(name)
+            while True:
+                total, count = totals.get(d, (0.0, 0))
+                totals[d] = (total + value, count + 1)
+                if not d:
+                    break
+                d = posixpath.dirname(d)
+        self.dir_means = dict((d, total / count)
+                              for d, (total, count) in totals.items())
+
+    def estimate(self, name):
+        """Return the expected value for the test "name", or None if nothing
+        is known about it."""
+        self._load()
+        value = self.values.get(name)
+        if value is not None:
+            return value
+        d = posixpath.dirname(name)
+        while True:
+            if d in self.dir_means:
+                return self.dir_means[d]
+            if not d:
+                return None
+            d = posixpath.dirname(d)
+
+    def update(self, values):
+        """Record the values of the tests of the latest run and save them."""
+        self._load()
+        self.values.update(values)
+        self._init_estimates()
+        libcxx.util.writeFileAtomic(self.path, json.dumps(self.values))
+
+
+class TestTimings(TestHistory):
+    """
+    The wall-clock time in seconds of each test.
+    """
+
+    # The fraction of the tests considered slow enough to be started first.
+    slow_fraction = 0.1
+
+    def _init_estimates(self):
+        super(TestTimings, self)._init_estimates()
+        self.slow_threshold = None
+        if self.values:
+            ordered = sorted(self.values.values(), reverse=True)
+            index = int(len(ordered) * self.slow_fraction)
+            self.slow_threshold = ordered[min(index, len(ordered) - 1)]
+
+    def is_slow(self, name):
+        """Return True if the test "name" is expected to be among the
+        slowest tests of the suite."""
+        elapsed = self.estimate(name)
+        return elapsed is not None and self.slow_threshold is not None \
+            and elapsed >= self.slow_threshold
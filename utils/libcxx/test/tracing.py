@@ -7,8 +7,10 @@
 #
 #===----------------------------------------------------------------------===##
 
-import os
 import inspect
+import json
+
+import libcxx.util
 
 
 def trace_function(function, log_calls, log_results, label=''):
@@ -41,3 +43,43 @@ def trace_object(obj, log_calls, log_results, label=''):
                 setattr(obj, name, trace_function(member, log_calls,
                                                   log_results, label))
     return obj
+
+
+def write_chrome_trace(path, spans):
+    """Write the 'span' events recorded through libcxx.util.traceSpan to
+    "path" in the Chrome trace event format, with one row per worker."""
+    events = []
+    for span in spans:
+        events += [{
+            'name': span['name'],
+            'cat': 'libcxx',
+            'ph': 'X',
+            'ts': int(span['start'] * 1e6),
+            'dur': int(span['duration'] * 1e6),
+            'pid': 0,
+            'tid': span['pid'],
+            'args': {'test': span['task']},
+        }]
+    events.sort(key=lambda e: e['ts'])
+    libcxx.util.writeFileAtomic(path, json.dumps({
+        'traceEvents': events, 'displayTimeUnit': 'ms'}))
+
+
+def format_span_summary(spans, count=10):
+    """Return a table of the time spent in each kind of span, followed by
+    the "count" slowest tests."""
+    totals = {}
+    for span in spans:
+        total, n = totals.get(span['name'], (0.0, 0))
+        totals[span['name']] = (total + span['duration'], n + 1)
+    lines = ['%-16s %10s %8s %10s' % ('phase', 'total (s)', 'count',
+                                     'mean (ms)')]
+    for name, (total, n) in sorted(totals.items(), key=lambda i: -i[1][0]):
+        lines += ['%-16s %10.2f %8d %10.1f' % (name, total, n,
+                                               total * 1000 / n)]
+    tests = sorted([s for s in spans if s['name'] == 'test'],
+                   key=lambda s: -s['duration'])[:count]
+    if tests:
+        lines += ['slowest tests:']
+        lines += ['%8.2fs  %s' % (s['duration'], s['task']) for s in tests]
+    return '\n'.join(lines)
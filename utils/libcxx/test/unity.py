@@ -0,0 +1,171 @@
+#===----------------------------------------------------------------------===##
+#
+#                     The LLVM Compiler Infrastructure
+#
+# This file is dual licensed under the MIT and the University of Illinois Open
+# Source Licenses. See LICENSE.TXT for details.
+#
+#===----------------------------------------------------------------------===##
+
+"""
+Support for compiling several .pass.cpp tests into a single executable.
+
+Each test is #included into its own namespace with 'main' renamed by a
+macro, so that its body becomes a lambda registered with a small dispatcher.
+The resulting program runs the test whose name is given as its first
+argument and exits with that test's exit code. Headers included at the top
+level of the tests are hoisted out of the namespaces so that the standard
+headers are parsed once, at global scope.
+"""
+
+import re
+
+
+# Keywords and constructs which prevent a test from being batched, either
+# because lit needs to evaluate them per test or because they cannot be
+# wrapped in a namespace.
+_incompatible_re = re.compile(
+    r'^\s*#\s*(define|undef|pragma)\b|'
+    r'\b(REQUIRES|UNSUPPORTED|XFAIL|FLAKY_TEST|MODULES_DEFINES|FILE-DEP)\b|'
+    r'\bnamespace\s+std\b|\b(struct|class)\s+std::|'
+    r'\boperator\s+(new|delete)\b|\bextern\s+"C"',
+    re.MULTILINE)
+
+_directive_re = re.compile(r'^\s*#\s*(\w+)(.*)$')
+_main_re = re.compile(r'\bint\s+main\s*\(')
+
+
+def _top_level_includes(contents):
+    """Return the #include lines outside of any preprocessor conditional,
+    or None if an #include appears inside a conditional."""
+    includes = []
+    depth = 0
+    for line in contents.splitlines():
+        m = _directive_re.match(line)
+        if not m:
+            continue
+        directive = m.group(1)
+        if directive in ('if', 'ifdef', 'ifndef'):
+            depth += 1
+        elif directive == 'endif':
+            depth -= 1
+        elif directive == 'include':
+            if depth != 0:
+                return None
+            includes += ['#include' + m.group(2).split('//')[0].rstrip()]
+    return includes
+
+
+def can_unity_build(contents):
+    """Return True if the test source "contents" can be batched with other
+    tests."""
+    if _incompatible_re.search(contents):
+        return False
+    if _top_level_includes(contents) is None:
+        return False
+    mains = list(_main_re.finditer(contents))
+    if len(mains) != 1:
+        return False
+    # 'main' must be the last definition in the file since the registration
+    # statement it is turned into is terminated after the #include.
+    body = contents[mains[0].start():]
+    depth = 0
+    for i, c in enumerate(body):
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return body[i + 1:].strip() == ''
+    return False
+
+
+_dispatcher_prologue = """\
+// Generated by the libc++ test format. Do not edit.
+%(includes)s
+
+namespace libcxx_unity_detail {
+struct entry {
+  void (*void_fn)();
+  int (*int_fn)();
+  void (*void_argv_fn)(int, char**);
+  int (*int_argv_fn)(int, char**);
+};
+entry entries[%(count)d];
+struct registrar {
+  explicit registrar(int i) : index(i) {}
+  int index;
+};
+inline int operator->*(registrar r, void (*f)()) {
+  entries[r.index].void_fn = f;
+  return 0;
+}
+inline int operator->*(registrar r, int (*f)()) {
+  entries[r.index].int_fn = f;
+  return 0;
+}
+inline int operator->*(registrar r, void (*f)(int, char**)) {
+  entries[r.index].void_argv_fn = f;
+  return 0;
+}
+inline int operator->*(registrar r, int (*f)(int, char**)) {
+  entries[r.index].int_argv_fn = f;
+  return 0;
+}
+inline int run(int index, int argc, char** argv) {
+  entry const& e = entries[index];
+  if (e.void_fn) { e.void_fn(); return 0; }
+  if (e.int_fn) return e.int_fn();
+  if (e.void_argv_fn) { e.void_argv_fn(argc, argv); return 0; }
+  if (e.int_argv_fn) return e.int_argv_fn(argc, argv);
+  return 2;
+}
+inline bool equal(const char* lhs, const char* rhs) {
+  while (*lhs && *lhs == *rhs) { ++lhs; ++rhs; }
+  return *lhs == *rhs;
+}
+} // namespace libcxx_unity_detail
+"""
+
+_test_wrapper = """
+namespace libcxx_unity_%(index)d {
+#define main(...) libcxx_unity_entry = \\
+    ::libcxx_unity_detail::registrar(%(index)d) ->* [](__VA_ARGS__)
+#include "%(path)s"
+;
+#undef main
+} // namespace libcxx_unity_%(index)d
+"""
+
+_dispatcher_epilogue = """
+int main(int argc, char** argv) {
+  if (argc < 2)
+    return 2;
+%(cases)s
+  return 2;
+}
+"""
+
+_dispatcher_case = """\
+  if (::libcxx_unity_detail::equal(argv[1], "%(name)s"))
+    return ::libcxx_unity_detail::run(%(index)d, argc - 1, argv + 1);"""
+
+
+def make_unity_source(sources):
+    """Return a translation unit which batches the tests "sources", a list of
+    (name, path, contents) tuples. The program it builds runs the test named
+    by its first argument."""
+    includes = []
+    for _, _, contents in sources:
+        for inc in _top_level_includes(contents):
+            if inc not in includes:
+                includes += [inc]
+    text = _dispatcher_prologue % {'includes': '\n'.join(includes),
+                                   'count': len(sources)}
+    cases = []
+    for index, (name, path, _) in enumerate(sources):
+        path = path.replace('\\', '/')
+        text += _test_wrapper % {'index': index, 'path': path}
+        cases += [_dispatcher_case % {'index': index, 'name': name}]
+    text += _dispatcher_epilogue % {'cases': '\n'.join(cases)}
+    return text
@@ -9,13 +9,18 @@
 
 from contextlib import contextmanager
 import errno
+import hashlib
+import itertools
 import os
 import platform
+import random
+import re
 import signal
 import subprocess
 import sys
 import tempfile
 import threading
+import time
 
 
 # FIXME: Most of these functions are cribbed from LIT
@@ -162,6 +167,326 @@ def mkdir_p(path):
             raise
 
 
+def _lockFile(f, blocking=True):
+    # Lock the open file "f". Return False if "blocking" is False and the
+    # lock is held by someone else.
+    if platform.system() == 'Windows':
+        import msvcrt
+        f.seek(0)
+        mode = msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), mode, 1)
+                return True
+            except IOError:
+                # LK_LOCK gives up after ten seconds; keep waiting.
+                if not blocking:
+                    return False
+    import fcntl
+    flags = fcntl.LOCK_EX
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+    try:
+        fcntl.flock(f.fileno(), flags)
+        return True
+    except (IOError, OSError):
+        if blocking:
+            raise
+        return False
+
+
+def _unlockFile(f):
+    if platform.system() == 'Windows':
+        import msvcrt
+        f.seek(0)
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        except IOError:
+            pass
+    f.close()
+
+
+@contextmanager
+def lockedFile(path):
+    """lockedFile(path) - Hold an exclusive lock on the file "path" for the
+    duration of a with statement. The file is created if it does not exist.
+    The lock is honored by every process that locks the same file through
+    this function."""
+    mkdir_p(os.path.dirname(path))
+    f = open(path, 'a+')
+    try:
+        _lockFile(f)
+    except:
+        f.close()
+        raise
+    try:
+        yield f
+    finally:
+        _unlockFile(f)
+
+
+class FileSemaphore(object):
+    """
+    A counting semaphore shared between processes.
+
+    Each of the "count" slots is a lock file within "directory", and a slot
+    is held while its file is locked. Slots are released automatically if
+    the process holding them dies.
+    """
+
+    def __init__(self, directory, count):
+        assert count > 0
+        self.directory = directory
+        self.count = count
+
+    @contextmanager
+    def acquire(self, blocking=True):
+        """Hold a free slot, and yield its number. If "blocking" is False
+        and every slot is taken, yield None instead of waiting."""
+        mkdir_p(self.directory)
+        first = random.randrange(self.count)
+        while True:
+            for i in range(self.count):
+                slot = (first + i) % self.count
+                f = open(os.path.join(self.directory, 'slot.%d' % slot), 'a+')
+                if _lockFile(f, blocking=False):
+                    try:
+                        yield slot
+                    finally:
+                        _unlockFile(f)
+                    return
+                f.close()
+            if not blocking:
+                yield None
+                return
+            time.sleep(0.01)
+
+
+def parseJobServerAuth(makeflags):
+    """parseJobServerAuth(makeflags) - Return how to reach the GNU make
+    jobserver described by "makeflags", as ('fifo', path) or
+    ('fds', read_fd, write_fd), or None if there is none."""
+    auth = None
+    for arg in makeflags.split():
+        for option in ('--jobserver-auth=', '--jobserver-fds='):
+            if arg.startswith(option):
+                # Recursive makes append their own; the last one wins.
+                auth = arg[len(option):]
+    if auth is None:
+        return None
+    if auth.startswith('fifo:'):
+        return ('fifo', auth[len('fifo:'):])
+    try:
+        read_fd, write_fd = [int(fd) for fd in auth.split(',')]
+    except ValueError:
+        return None
+    if read_fd < 0 or write_fd < 0:
+        return None
+    return ('fds', read_fd, write_fd)
+
+
+class JobServer(object):
+    """
+    A client of a GNU make jobserver, which limits how many jobs the whole
+    build runs at the same time.
+
+    make grants one implicit token to lit itself, which is shared by the
+    processes of the run as a FileSemaphore with a single slot in
+    "directory". Past that one, every job reads a token from the jobserver
+    before it starts and writes it back once it is done.
+    """
+
+    def __init__(self, auth, directory):
+        self.auth = auth
+        self.implicit = FileSemaphore(directory, 1)
+        self.fds = None
+
+    def __getstate__(self):
+        # Each process opens the jobserver itself.
+        state = dict(self.__dict__)
+        state['fds'] = None
+        return state
+
+    def _open(self):
+        if self.fds is None:
+            if self.auth[0] == 'fifo':
+                fd = os.open(self.auth[1], os.O_RDWR)
+                self.fds = (fd, fd)
+            else:
+                self.fds = self.auth[1:]
+        return self.fds
+
+    def _read_token(self, read_fd, timeout):
+        import select
+        readable, _, _ = select.select([read_fd], [], [], timeout)
+        if not readable:
+            return None
+        try:
+            token = os.read(read_fd, 1)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return None
+            raise
+        return token or None
+
+    @contextmanager
+    def acquire(self):
+        """Hold a token while running a job."""
+        read_fd, write_fd = self._open()
+        while True:
+            with self.implicit.acquire(blocking=False) as slot:
+                if slot is not None:
+                    yield
+                    return
+            token = self._read_token(read_fd, 0.05)
+            if token is not None:
+                break
+        try:
+            yield
+        finally:
+            os.write(write_fd, token)
+
+
+_reservationIds = itertools.count()
+
+
+class MemoryBudget(object):
+    """
+    A number of bytes of memory shared between processes.
+
+    Each reservation is a lock file within "directory" whose name records
+    the number of bytes reserved, and it is held while its file is locked.
+    Reservations are released automatically if the process holding them
+    dies.
+    """
+
+    def __init__(self, directory, budget):
+        assert budget > 0
+        self.directory = directory
+        self.budget = budget
+
+    def _reserved(self):
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.startswith('reservation.'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                f = open(path, 'r')
+            except (IOError, OSError):
+                continue
+            if _lockFile(f, blocking=False):
+                # Left behind by a process which is gone.
+                _unlockFile(f)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            f.close()
+            total += int(name.split('.')[-1])
+        return total
+
+    @contextmanager
+    def acquire(self, amount):
+        """Reserve "amount" bytes for the duration of a with statement,
+        waiting until they fit in the budget. A reservation larger than the
+        whole budget is granted once nothing else is reserved."""
+        if amount <= 0:
+            yield
+            return
+        mkdir_p(self.directory)
+        # Each reservation needs a file of its own, even when threads of one
+        # process reserve the same amount.
+        path = os.path.join(self.directory, 'reservation.%d.%d.%d.%d'
+                            % (os.getpid(), threading.current_thread().ident,
+                               next(_reservationIds), amount))
+        while True:
+            with lockedFile(os.path.join(self.directory, 'lock')):
+                reserved = self._reserved()
+                if reserved == 0 or reserved + amount <= self.budget:
+                    f = open(path, 'a+')
+                    _lockFile(f)
+                    break
+            time.sleep(0.05)
+        try:
+            yield
+        finally:
+            _unlockFile(f)
+            cleanFile(path)
+
+
+def hashData(*parts):
+    """hashData(parts...) - Return a hex digest identifying the given
+    strings. Lists of strings may be passed in place of a single string."""
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, (list, tuple)):
+            part = '\0'.join(part)
+        h.update(to_bytes(part))
+        h.update(b'\1')
+    return h.hexdigest()
+
+
+def hashFile(path):
+    """hashFile(path) - Return a hex digest of the contents of "path"."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def replaceFile(src, dst):
+    """replaceFile(src, dst) - Rename "src" to "dst", replacing "dst" if it
+    already exists."""
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    # Python 2 has no os.replace and os.rename refuses to overwrite on Windows.
+    if platform.system() == 'Windows':
+        cleanFile(dst)
+    os.rename(src, dst)
+
+
+def writeFileAtomic(path, data):
+    """writeFileAtomic(path, data) - Write "data" to "path" so that
+    concurrent readers observe either the old or the new contents, never a
+    partially written file."""
+    dirname = os.path.dirname(path)
+    mkdir_p(dirname)
+    handle, tmp_name = tempfile.mkstemp(prefix='.tmp', dir=dirname)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(to_bytes(data))
+        replaceFile(tmp_name, path)
+    except:
+        cleanFile(tmp_name)
+        raise
+
+
+def parseDepFile(path):
+    """parseDepFile(path) - Return the list of prerequisites recorded in the
+    Makefile style dependency file "path" (as written by -MD), or None if the
+    file cannot be read."""
+    try:
+        with open(path, 'r') as f:
+            contents = f.read()
+    except (IOError, OSError):
+        return None
+    contents = contents.replace('\\\n', ' ').replace('\\\r\n', ' ')
+    # The target may itself contain ':' (e.g. 'C:\\foo.o') so split on the
+    # first ': ' which separates the target from its prerequisites.
+    _, sep, prereqs = contents.partition(': ')
+    if not sep:
+        return None
+    deps = []
+    for dep in re.split(r'(?<!\\)\s+', prereqs.strip()):
+        if dep:
+            deps.append(dep.replace('\\ ', ' '))
+    return deps
+
+
 class ExecuteCommandTimeoutException(Exception):
     def __init__(self, msg, out, err, exitCode):
         assert isinstance(msg, str)
@@ -176,6 +501,108 @@ class ExecuteCommandTimeoutException(Exception):
 # Close extra file handles on UNIX (on Windows this cannot be done while
 # also redirecting input).
 kUseCloseFDs = not (platform.system() == 'Windows')
+_usageTrackers = threading.local()
+
+# The pids of the commands being run by executeCommand in this process.
+_activeCommands = set()
+
+
+def killActiveCommands():
+    """killActiveCommands() - Kill the commands being run by executeCommand
+    in any thread of this process, and all of their children."""
+    for pid in list(_activeCommands):
+        killProcessAndChildren(pid)
+
+
+@contextmanager
+def trackResourceUsage():
+    """trackResourceUsage() - Yield a dict whose 'max_rss' entry is the peak
+    resident set size, in bytes, of the commands run by executeCommand in
+    this thread during the with statement. It stays 0 on platforms without
+    os.wait4."""
+    usage = {'max_rss': 0}
+    trackers = getattr(_usageTrackers, 'stack', None)
+    if trackers is None:
+        trackers = _usageTrackers.stack = []
+    trackers.append(usage)
+    try:
+        yield usage
+    finally:
+        trackers.remove(usage)
+
+
+_traceState = threading.local()
+
+
+@contextmanager
+def tracedTask(sink, name):
+    """tracedTask(sink, name) - Attribute the spans recorded in this thread
+    during the with statement to the task "name", and record them as
+    'span' events of "sink" (a RunStatistics). Nothing is recorded if
+    "sink" is None."""
+    previous = getattr(_traceState, 'task', None)
+    _traceState.task = (sink, name) if sink is not None else None
+    try:
+        yield
+    finally:
+        _traceState.task = previous
+
+
+@contextmanager
+def traceSpan(name):
+    """traceSpan(name) - Record the time spent in the with statement as the
+    span "name" of the current traced task, if any."""
+    task = getattr(_traceState, 'task', None)
+    if task is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        sink, task_name = task
+        sink.record('span', name=name, task=task_name, pid=os.getpid(),
+                    start=start, duration=time.time() - start)
+
+
+def _communicateWithUsage(p, input):
+    # Do what p.communicate(input) and p.wait() do, but reap the process
+    # with os.wait4 to learn its resource usage. Return (out, err, rusage).
+    chunks = {}
+
+    def read(name, f):
+        chunks[name] = f.read()
+        f.close()
+
+    readers = [threading.Thread(target=read, args=(name, f))
+               for name, f in [('out', p.stdout), ('err', p.stderr)]]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    try:
+        if input:
+            p.stdin.write(input)
+        p.stdin.close()
+    except (IOError, OSError) as e:
+        # The command exited without reading all of its input.
+        if e.errno not in (errno.EPIPE, errno.EINVAL):
+            raise
+    for reader in readers:
+        reader.join()
+    while True:
+        try:
+            _, status, rusage = os.wait4(p.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    return chunks['out'], chunks['err'], rusage
+
+
 def executeCommand(command, cwd=None, env=None, input=None, timeout=0):
     """
         Execute command ``command`` (list of arguments or string)
@@ -202,6 +629,7 @@ def executeCommand(command, cwd=None, env=None, input=None, timeout=0):
                          stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE,
                          env=env, close_fds=kUseCloseFDs)
+    _activeCommands.add(p.pid)
     timerObject = None
     # FIXME: Because of the way nested function scopes work in Python 2.x we
     # need to use a reference to a mutable object rather than a plain
@@ -219,9 +647,21 @@ def executeCommand(command, cwd=None, env=None, input=None, timeout=0):
             timerObject = threading.Timer(timeout, killProcess)
             timerObject.start()
 
-        out,err = p.communicate(input=input)
-        exitCode = p.wait()
+        trackers = getattr(_usageTrackers, 'stack', None)
+        if trackers and hasattr(os, 'wait4'):
+            out, err, rusage = _communicateWithUsage(p, input)
+            exitCode = p.returncode
+            # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+            max_rss = rusage.ru_maxrss
+            if platform.system() != 'Darwin':
+                max_rss *= 1024
+            for usage in trackers:
+                usage['max_rss'] = max(usage['max_rss'], max_rss)
+        else:
+            out,err = p.communicate(input=input)
+            exitCode = p.wait()
     finally:
+        _activeCommands.discard(p.pid)
         if timerObject != None:
             timerObject.cancel()
 